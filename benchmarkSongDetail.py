@@ -0,0 +1,70 @@
+import json
+import time
+import jsonCodec
+from neteaseMusic import AsyncNeteaseMusic
+
+
+def song_detail(count:int):
+    '''
+    A `song/detail` response of the ncmApi with `count` tracks
+    '''
+    song = lambda i: {
+        'name': 'Song {}'.format(i), 'id': i, 'dt': 215000, 'publishTime': 1262275200000,
+        'ar': [{'id': 1000 + i, 'name': 'Artist {}'.format(i), 'tns': [], 'alias': []}],
+        'al': {'id': 2000 + i, 'name': 'Album {}'.format(i), 'picUrl': 'https://p1.music.126.net/{}.jpg'.format(i), 'tns': []},
+        'h': {'br': 320000, 'fid': 0, 'size': 8600000, 'vd': -2},
+        'm': {'br': 192000, 'fid': 0, 'size': 5160000, 'vd': -2},
+        'l': {'br': 128000, 'fid': 0, 'size': 3440000, 'vd': -2},
+        'noCopyrightRcmd': None, 'fee': 8, 'pop': 100, 'mv': 0, 'alia': []
+    }
+    privilege = lambda i: {'id': i, 'fee': 8, 'payed': 0, 'st': 0, 'pl': 128000, 'dl': 0, 'maxbr': 999000, 'fl': 128000}
+    return json.dumps({
+        'songs': [song(i) for i in range(count)],
+        'privileges': [privilege(i) for i in range(count)],
+        'code': 200
+    }).encode()
+
+
+def benchmark(count:int=1000):
+    '''
+    Time turning a `count` track `song/detail` response into song records the
+    way `get_song` used to (the body parsed again for every track's privileges,
+    then scanned for error markers) and the way it does now (one parse by each
+    backend, then `AsyncNeteaseMusic._song_record` per track)
+    '''
+    body = song_detail(count)
+    text = body.decode()
+    # `_song_record` needs no configuration, the client is not initialised
+    ncm = AsyncNeteaseMusic.__new__(AsyncNeteaseMusic)
+
+    def per_track():
+        songs = json.loads(text)['songs']
+        if '"code":400' in text or 'Internal Server Error' in text:
+            return
+        for i, song in enumerate(songs):
+            ncm._song_record(song, json.loads(text)['privileges'][i])
+
+    def single(decode):
+        def run():
+            resp = decode(body)
+            if resp.get('code') != 200:
+                return
+            [ncm._song_record(song, privilege) for song, privilege in zip(resp['songs'], resp['privileges'])]
+        return run
+
+    cases = [('parse per track', per_track, 1), ('single parse, json', single(json.loads), 20)]
+    if jsonCodec.orjson is not None:
+        cases.append(('single parse, orjson', single(jsonCodec.orjson.loads), 20))
+
+    baseline = None
+    for name, run, repeat in cases:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            run()
+        elapsed = (time.perf_counter() - start) / repeat
+        baseline = baseline or elapsed
+        print('{:<22}{:>10.2f} ms{:>10.0f}x'.format(name, elapsed * 1000, baseline / elapsed))
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,65 @@
+import time
+from collections import OrderedDict
+
+
+class TTLCache():
+    '''
+    A least recently used cache whose entries also expire after a time to live.
+    '''
+
+    def __init__(self, maxsize=1024, ttl=600):
+        '''
+        :Args:
+            - maxsize `int`: most entries kept before the least recently used one is evicted
+            - ttl `float`: default seconds an entry stays valid
+        '''
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()     # key -> (expiry, value)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def get(self, key, default=None, count=True):
+        entry = self._data.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._data.move_to_end(key)
+            if count:
+                self.hits += 1
+            return entry[1]
+
+        if entry is not None:   # expired
+            del self._data[key]
+        if count:
+            self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size' : len(self._data),
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'hitRate' : self.hits / total if total else 0.0
+        }
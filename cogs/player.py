@@ -1,37 +1,117 @@
 import discord
 from discord.ext import commands
 import asyncio
+import functools
 import math
 # import queuelist
 import os
 from voiceState import VoiceState
 from songQueue import SongQueue
-from neteaseMusic import NeteaseMusic
+from neteaseMusic import AsyncNeteaseMusic
+from playlistImporter import PlaylistImporter
+from searchCache import SearchCache
+from qualityPolicy import QualityPolicy
+from queueStore import QueueStore
 import musicSource
+import sharedSource
 import datetime
 import time
 
 
 class Player(commands.Cog, name = 'Music Playback Commands'):
+
+    PROGRESS_INTERVAL = 2       # seconds between edits of a progress message
+    SKIPPED_DISPLAY_LIMIT = 20  # skipped song ids listed in the import summary
+    IDLE_TIMEOUT = 300          # seconds an idle voice state is kept
+    REAP_INTERVAL = 60          # seconds between checks for idle voice states
+
     def __init__(self, client: commands.Bot):
         self.client = client
-        self.music = NeteaseMusic()
+        self.music = AsyncNeteaseMusic()
         self.currentSong = {}
         # self.playlist = queuelist.QueueList()
         # self.songs = SongQueue()
         self.voice_states = {}
+        self.idleTimeout = self.music.config.getfloat('config', 'idle_timeout', fallback=self.IDLE_TIMEOUT)
+        self.reaper = self.client.loop.create_task(self.reap_idle_states())
+        # queues survive a restart of the bot or a reload of the cog
+        self.snapshots = QueueStore(path=self.music.config.get('config', 'queue_db', fallback=QueueStore.PATH))
+        self.restorer = self.client.loop.create_task(self.restore_states())
     
-    def get_voice_state(self, ctx: commands.Context):
+    def get_voice_state(self, ctx: commands.Context, create=True):
+        '''
+        :Args:
+            - create `bool`: keep a new state for the guild, otherwise a guild
+                without one gets a throwaway state that is never started
+        '''
         state = self.voice_states.get(ctx.guild.id)
         if not state:
-            state = VoiceState(self.client, ctx)
-            self.voice_states[ctx.guild.id] = state
+            state = VoiceState(self.client, ctx, self.music)
+            if create:
+                self.voice_states[ctx.guild.id] = state
+                self.watch_state(ctx.guild.id, state)
 
+        state.touch()
         return state
 
+    def watch_state(self, guildId: int, state: VoiceState):
+        # every change of the state is written to its guild's snapshot
+        state.on_update = functools.partial(self.snapshots.mark, guildId, state)
+
+    async def reap_idle_states(self):
+        '''
+        Release the voice states of guilds that have not played anything for a while,
+        unless they hold settings a member chose
+        '''
+        while True:
+            await asyncio.sleep(self.REAP_INTERVAL)
+            now = time.monotonic()
+            for guildId, state in list(self.voice_states.items()):
+                if state.idle and not state.customised and now - state.lastActive > self.idleTimeout:
+                    del self.voice_states[guildId]
+                    await state.close()
+                elif state.is_playing:
+                    # keep the saved position of the playing track recent
+                    self.snapshots.mark(guildId, state)
+
+    async def restore_states(self):
+        '''
+        Resume the queues saved before the bot restarted or the cog was reloaded
+        '''
+        await self.client.wait_until_ready()
+        for guildId, snapshot in self.snapshots.load().items():
+            guild = self.client.get_guild(guildId)
+            if guild is None or guildId in self.voice_states:
+                self.snapshots.save(guildId, None)
+                continue
+            state = VoiceState(self.client, None, self.music)
+            self.voice_states[guildId] = state
+            try:
+                restored = await state.restore(snapshot, guild)
+            except Exception as e:
+                print(f'ERROR: {type(e).__name__} - {e}')
+                restored = False
+            if not restored:
+                self.voice_states.pop(guildId, None)
+                self.snapshots.save(guildId, None)
+                await state.close()
+                continue
+            print('Restored {} tracks in {}'.format(len(state.songs), guild))
+            self.watch_state(guildId, state)
+            self.snapshots.mark(guildId, state)
+
     def cog_unload(self):
+        self.reaper.cancel()
+        self.restorer.cancel()
+        # save where every guild is before closing its state clears the queue
+        for guildId, state in self.voice_states.items():
+            state.on_update = None
+            self.snapshots.save(guildId, state.snapshot())
+        self.snapshots.close()
+        # stopped right away and left connected, the reloaded cog plays on in the same connection
         for state in self.voice_states.values():
-            self.client.loop.create_task(state.stop())
+            state.detach()
+        self.client.loop.create_task(self.music.close())
 
     def cog_check(self, ctx: commands.Context):
         if not ctx.guild:
@@ -40,7 +120,8 @@ class Player(commands.Cog, name = 'Music Playback Commands'):
         return True
 
     async def cog_before_invoke(self, ctx: commands.Context):
-        ctx.voice_state = self.get_voice_state(ctx)
+        # commands that keep state in the guild create it in their own before_invoke hook
+        ctx.voice_state = self.get_voice_state(ctx, create=False)
 
     # async def cog_command_error(self, ctx: commands.Context, error: commands.CommandError):
     #     errorMsg = 'An error occurred: {}'.format(str(error))
@@ -110,27 +191,27 @@ class Player(commands.Cog, name = 'Music Playback Commands'):
         if not ctx.voice_state.voice:
             return await ctx.send('Not connected to any voice channel.')
 
-        await ctx.voice_state.stop()
-        del self.voice_states[ctx.guild.id]
+        self.voice_states.pop(ctx.guild.id, None)
+        await ctx.voice_state.close()
 
 
     @commands.command()
     async def search(self, ctx:commands.Context, *, keyword:str):
         # default displaying 10 results
         count = 10
-        query = keyword.split('-')[-1]
-        if query.isdigit() and 0 < int(query) < 50:
-            count = int(query)
+        keywords, query = SearchCache.parse_query(keyword)
+        if query is not None:
+            count = query
 
         author = ctx.author
         channel = ctx.channel
         # menu = ''   # research results
 
         await ctx.trigger_typing()
-        results = self.music.search(keyword)
+        results = await self.music.search(keywords, limit=count)
         displayNum = results.get('query').get('numDisplayed')
         embed = discord.Embed(
-            title = 'Search results of "%s":' % keyword,
+            title = 'Search results of "%s":' % keywords,
             description = 'Please select a track from # **1-{}**: '.format(displayNum),
             timestamp = datetime.datetime.utcnow(),
             colour = discord.Colour.green()
@@ -174,32 +255,56 @@ class Player(commands.Cog, name = 'Music Playback Commands'):
             await ctx.invoke(self.join)
 
         if keyword.startswith('http'):
-            songId = self.music.search_by_url(keyword)['id']
+            songId = (await self.music.search_by_url(keyword))['id']
         else:
             songId = await ctx.invoke(self.search, keyword=keyword)
 
         await ctx.trigger_typing()
         try:
-            source = await musicSource.NetEaseMusicSource.create_source(ctx, songId, br=320000, download=True)
+            music = await musicSource.Music.create(ctx, songId, br=ctx.voice_state.target_bitrate(ctx), download=True, ncm=self.music)
         except musicSource.NetEaseMusicError as e:
             print(str(e))
             await ctx.send('An error occurred while processing this request: {}'.format(str(e)))
         else:
-            if source: # valid music source (song)
-                music = musicSource.Music(source)
-                await ctx.voice_state.songs.put(music)
+            if music: # valid music (song)
+                try:
+                    ctx.voice_state.songs.put_nowait(music)
+                except asyncio.QueueFull:
+                    return await ctx.send('The queue is full! Try again once a few songs have played.')
                 # print(ctx.voice_state.songs)
-                await ctx.send('Sucessfully added {} to queue!'.format(str(source)))
+                await ctx.send('Sucessfully added {} to queue!'.format(str(music)))
+                # fetch the file while earlier songs play, the player joins this download
+                if self.music.library.get(music.songId, music.br) is None:
+                    self.client.loop.create_task(self.download(ctx, music))
                 # print('all voice states: ', self.voice_states)
 
                 # await ctx.send(embed=song.create_embed())
                 # ctx.voice_client.play(song.source, after=lambda e: print('Player error: %s' % e) if e else print('Finished playing!'))
             else:
-                msg = 'Unavailable! Failed to add `{}` to queue!'.format(self.music.get_song(songId)[0].get('title'))
+                msg = 'Unavailable! Failed to add `{}` to queue!'.format((await self.music.get_song(songId))[0].get('title'))
                 print(msg)
                 await ctx.send(msg)
 
 
+    async def download(self, ctx:commands.Context, music:musicSource.Music):
+        message = await ctx.send('Downloading {}...'.format(str(music)))
+        lastEdit = time.monotonic()
+
+        async def progress(received, total):
+            nonlocal lastEdit
+            if time.monotonic() - lastEdit < self.PROGRESS_INTERVAL:
+                return
+            lastEdit = time.monotonic()
+            await message.edit(content='Downloading {}: `{:.0%}` of {:.1f} MB'.format(
+                str(music), received / total if total else 0, total / 1_000_000))
+
+        path = await self.music.download(music.songId, bitrate=music.br, progress=progress)
+        if path is None:
+            await message.edit(content='Download of {} failed, it will be streamed instead.'.format(str(music)))
+        else:
+            await message.edit(content='Downloaded {}!'.format(str(music)))
+
+
     @commands.command()
     async def queue(self, ctx: commands.Context, *, page: int = 1):
         if len(ctx.voice_state.songs) == 0:
@@ -213,45 +318,109 @@ class Player(commands.Cog, name = 'Music Playback Commands'):
 
         queue = ''
         for i, song in enumerate(ctx.voice_state.songs[start:end], start=start):
-            artist = ' & '.join([i['name'] for i in song.source.data['artist']])
-            queue += '`{0}.` {1} - [{2[title]}]({2[url]}) • {2[length]}\n'.format(i + 1, artist, song.source.data)
+            artist = ' & '.join(artist.name for artist in song.track.artists)
+            queue += '`{0}.` {1} - [{2.title}]({2.url}) • {2.length}\n'.format(i + 1, artist, song.track)
 
         embed = (discord.Embed(description='**{} tracks next up:**\n\n{}'.format(ctx.voice_state.songs.size(), queue))
                  .set_footer(text='Viewing page {}/{}'.format(page, pages)))
         await ctx.send(embed=embed)
 
 
+    @commands.command()
+    async def fair(self, ctx: commands.Context, mode: str = None):
+        '''
+        Play the queued songs in turns per requester (on) or in the order they were added (off)
+        '''
+        songs = ctx.voice_state.songs
+        if mode is None:
+            return await ctx.send('Fair queue is {}'.format('on' if songs.fair else 'off'))
+        if mode not in ('on', 'off'):
+            return await ctx.send('Mode must be on or off!')
+
+        songs.set_fair(mode == 'on', ctx.voice_state.requester_of)
+        await ctx.send('Fair queue turned {}'.format(mode))
+
+
+    @commands.command()
+    async def weight(self, ctx: commands.Context, member: discord.Member, weight: int):
+        '''
+        Give a member's songs more turns in the fair queue
+        '''
+        songs = ctx.voice_state.songs
+        if not songs.fair:
+            return await ctx.send('Fair queue is off! Turn it on with `.fair on`.')
+        if not 1 <= weight <= 10:
+            return await ctx.send('Weight must be between 1 and 10!')
+
+        songs.set_weight(member.id, weight)
+        await ctx.send('{} now gets {} song(s) per turn'.format(member.display_name, weight))
+
+
+    @commands.command()
+    async def shuffle(self, ctx: commands.Context):
+        if len(ctx.voice_state.songs) == 0:
+            return await ctx.send('Empty queue.')
+
+        ctx.voice_state.songs.shuffle()
+        await ctx.message.add_reaction('\U0001F500')
+
+
+    @commands.command()
+    async def remove(self, ctx: commands.Context, index: int):
+        if not 1 <= index <= len(ctx.voice_state.songs):
+            return await ctx.send('Invalid index! The queue has {} tracks.'.format(len(ctx.voice_state.songs)))
+
+        song = ctx.voice_state.songs[index - 1]
+        ctx.voice_state.songs.remove(index - 1)
+        await ctx.send('Removed {} from the queue'.format(str(song)))
+
+
+    @commands.command()
+    async def move(self, ctx: commands.Context, source: int, destination: int):
+        size = len(ctx.voice_state.songs)
+        if not (1 <= source <= size and 1 <= destination <= size):
+            return await ctx.send('Invalid index! The queue has {} tracks.'.format(size))
+
+        # in fair mode the track only moves among its requester's tracks
+        index = ctx.voice_state.songs.move(source - 1, destination - 1)
+        await ctx.send('Moved {} to position {}'.format(str(ctx.voice_state.songs[index]), index + 1))
+
+
     @commands.command()
     async def playlist(self, ctx:commands.Context, *, url:str):
         if not ctx.voice_state.voice:
             await ctx.invoke(self.join)
                     
-        playlist = self.music.get_playlist(url)
+        playlist = await self.music.get_playlist(url)
+        if not playlist:
+            return await ctx.send('Invalid! Please double check your playlist ID.')
         ids = playlist['playlist']['trackIds']
 
         # async with ctx.typing():
         await ctx.trigger_typing()
         message = await ctx.send('Starting to import songs from playlist...')
-        for index, songId in enumerate(ids, 1):
-            try:
-                source = await musicSource.NetEaseMusicSource.create_source(ctx, songId, br=320000, download=False)
-            except musicSource.NetEaseMusicError as e:
-                print(str(e))
-                await ctx.send('An error occurred while processing this request: {}'.format(str(e)))
-            else:
-                if source:  # valid music source (song)
-                    music = musicSource.Music(source)
-                    await ctx.voice_state.songs.put(music)
-                    await message.edit(content='Adding `{}/{}` songs: {}'.format(index, len(ids), str(source)))
-                else:
-                    msg = 'Unavailable! Skipping song# {} `{}` with `ID:{}`'.format(
-                        index,
-                        self.music.get_song(songId)[0].get('title'),
-                        songId)
-                    print(msg)
-                    await message.edit(content=msg)
-            
-        await message.edit(content='All songs has been added to the player queue!')
+        lastEdit = 0
+
+        async def progress(importer, music):
+            nonlocal lastEdit
+            # editing on every track would hit the rate limit on long playlists
+            if music is None or time.monotonic() - lastEdit < self.PROGRESS_INTERVAL:
+                return
+            lastEdit = time.monotonic()
+            await message.edit(content='Adding `{}/{}` songs: {}'.format(importer.done, importer.total, str(music)))
+
+        importer = PlaylistImporter(ctx, self.music, ctx.voice_state.songs, br=ctx.voice_state.target_bitrate(ctx), progress=progress)
+        skipped = await importer.run(ids)
+
+        summary = '`{}/{}` songs has been added to the player queue!'.format(importer.added, importer.total)
+        if skipped:
+            summary += '\nUnavailable! Skipped {} song(s) with `ID: {}`'.format(
+                len(skipped),
+                ', '.join(str(songId) for songId, reason in skipped[:self.SKIPPED_DISPLAY_LIMIT]))
+            if len(skipped) > self.SKIPPED_DISPLAY_LIMIT:
+                summary += ' and {} more'.format(len(skipped) - self.SKIPPED_DISPLAY_LIMIT)
+            print('Skipped songs:', skipped)
+        await message.edit(content=summary)
         await message.add_reaction('\U0001F44D')
 
 
@@ -260,10 +429,10 @@ class Player(commands.Cog, name = 'Music Playback Commands'):
         if not ctx.voice_state.voice:
             await ctx.send('No song is playing currently!')
         else:
-            currentSong = ctx.voice_state.current.source
+            currentSong = ctx.voice_state.current
             songId = currentSong.id
             try:
-                lyric = self.music.get_lyric(songId)
+                lyric = await self.music.get_lyric(songId)
             except Exception as e:
                 print(f'ERROR: {type(e).__name__} - {e}')
                 await ctx.send('Invalid `song ID` or `lyric` is unavaliable!')
@@ -288,10 +457,10 @@ class Player(commands.Cog, name = 'Music Playback Commands'):
         if not ctx.voice_state.voice:
             await ctx.send('No song is playing currently!')
         else:
-            currentSong = ctx.voice_state.current.source
+            currentSong = ctx.voice_state.current
             songId = currentSong.id
             try:
-                comments = self.music.get_music_comments(songId, limit=count)
+                comments = await self.music.get_music_comments(songId, limit=count)
                 hc = comments.get('hotComments')
             except Exception as e:
                 print(f'ERROR: {type(e).__name__} - {e}')
@@ -365,6 +534,60 @@ class Player(commands.Cog, name = 'Music Playback Commands'):
             await ctx.send('Nothing to resume!')
 
 
+    @commands.command()
+    async def seek(self, ctx:commands.Context, position:str):
+        '''
+        Jump to a position of the current song, in seconds or mm:ss
+        '''
+        current = ctx.voice_state.current
+        if not ctx.voice_state.is_playing or current.source is None:
+            return await ctx.send('There is nothing playing!')
+
+        try:
+            seconds = sum(float(part) * 60 ** i for i, part in enumerate(reversed(position.split(':'))))
+        except ValueError:
+            return await ctx.send('Position must be in seconds or mm:ss!')
+        duration = current.data.get('duration', 0) / 1000
+        if not 0 <= seconds < duration:
+            return await ctx.send('Position must be between 00:00 and {}!'.format(current.data.get('length')))
+
+        try:
+            await ctx.voice_state.restart(seconds)
+        except musicSource.NetEaseMusicError as e:
+            return await ctx.send(str(e))
+        await ctx.send('Jumped to %02d:%02d' % divmod(seconds, 60))
+
+
+    @commands.command()
+    async def quality(self, ctx:commands.Context, bitrate:str=None):
+        '''
+        Show or set the bitrate songs are fetched at: 128, 192, 320, 999 (lossless) or auto
+        '''
+        if bitrate is None:
+            mode = 'set' if ctx.voice_state.bitrate else 'matching the voice channel'
+            return await ctx.send('Songs are fetched at {} kbps ({})'.format(ctx.voice_state.target_bitrate(ctx) // 1000, mode))
+
+        if bitrate == 'auto':
+            ctx.voice_state.bitrate = None
+        elif bitrate.isdigit() and int(bitrate) * 1000 in QualityPolicy.LADDER:
+            ctx.voice_state.bitrate = int(bitrate) * 1000
+        else:
+            return await ctx.send('Bitrate must be one of {} or auto!'.format(', '.join(str(br // 1000) for br in QualityPolicy.LADDER)))
+        await ctx.send('Songs added from now on are fetched at {} kbps'.format(ctx.voice_state.target_bitrate(ctx) // 1000))
+
+
+    @commands.command()
+    async def volume(self, ctx:commands.Context, volume:int):
+        if not ctx.voice_state.is_playing:
+            return await ctx.send('There is nothing playing!')
+
+        if not 0 <= volume <= 100:
+            return await ctx.send('Volume must be between 0 and 100!')
+
+        ctx.voice_state.volume = volume / 100
+        await ctx.send('Volume of the player set to {}%'.format(volume))
+
+
     @commands.command()
     async def stop(self, ctx):
         # if ctx.voice_client.is_playing():
@@ -378,7 +601,64 @@ class Player(commands.Cog, name = 'Music Playback Commands'):
         if ctx.voice_state.is_playing:
             ctx.voice_state.voice.stop()
             await ctx.message.add_reaction('⏹')
-        
+
+
+    @commands.command(name = 'memory', hidden = True)
+    @commands.is_owner()
+    async def memory_stats(self, ctx:commands.Context):
+        usage = [(guildId, state.memory()) for guildId, state in self.voice_states.items()]
+        usage.sort(key = lambda item: item[1]['queue'] + item[1]['buffers'], reverse = True)
+        total = sum(memory['queue'] + memory['buffers'] for _, memory in usage)
+
+        embed = discord.Embed(
+            title = 'Memory per guild',
+            description = '{} voice states • {:.1f} MB'.format(len(usage), total / 1_000_000),
+            color = discord.Color.dark_grey()
+        )
+        # an embed holds at most 25 fields
+        for guildId, memory in usage[:20]:
+            guild = self.client.get_guild(guildId)
+            embed.add_field(
+                name = guild.name if guild else str(guildId),
+                value = '{tracks} tracks • queue {queueMB:.2f} MB • buffers {buffersMB:.2f} MB'.format(
+                    queueMB = memory['queue'] / 1_000_000, buffersMB = memory['buffers'] / 1_000_000, **memory),
+                inline = False
+            )
+        await ctx.send(embed = embed)
+
+
+    @commands.command(name = 'cache', hidden = True)
+    @commands.is_owner()
+    async def cache_stats(self, ctx:commands.Context):
+        caches = {
+            'Search' : self.music.searchCache.stats(),
+            'Audio url' : self.music.urlCache.stats(),
+            'API response' : self.music.responseCache.stats()
+        }
+        embed = discord.Embed(title = 'Cache statistics', color = discord.Color.dark_grey())
+        for name, stats in caches.items():
+            embed.add_field(
+                name = name,
+                value = '{size} entries • {hits} hits • {misses} misses • {rate:.0%} hit rate'.format(rate = stats['hitRate'], **stats),
+                inline = False
+            )
+        shared = sharedSource.broker.stats()
+        embed.add_field(
+            name = 'Shared decode',
+            value = '{streams} ffmpeg processes • {readers} players'.format(**shared),
+            inline = False
+        )
+        # an embed holds at most 25 fields
+        playing = [(guildId, state) for guildId, state in self.voice_states.items() if state.is_playing][:20]
+        for guildId, state in playing:
+            guild = self.client.get_guild(guildId)
+            embed.add_field(
+                name = 'Buffer • {}'.format(guild.name if guild else guildId),
+                value = '{fill}/{capacity} frames • {underruns} underruns'.format(**state.buffer_stats()),
+                inline = False
+            )
+        await ctx.send(embed = embed)
+
 
 
     @join.before_invoke
@@ -404,6 +684,16 @@ class Player(commands.Cog, name = 'Music Playback Commands'):
             if ctx.voice_client.channel != ctx.author.voice.channel:
                 raise commands.CommandError('Bot is already in a voice channel.')
 
+        ctx.voice_state = self.get_voice_state(ctx)
+        ctx.voice_state.start()
+
+
+    @quality.before_invoke
+    @fair.before_invoke
+    @weight.before_invoke
+    async def create_voice_state(self, ctx: commands.Context):
+        ctx.voice_state = self.get_voice_state(ctx)
+
 
 def setup(client):
     client.add_cog(Player(client))
\ No newline at end of file
@@ -0,0 +1,143 @@
+import threading
+from array import array
+
+
+class FrameRing():
+    '''
+    A fixed number of audio frames stored in one preallocated buffer.
+    Frames are addressed by their absolute index; once the ring is full the
+    oldest frame is overwritten.
+    '''
+
+    def __init__(self, capacity:int, frameSize:int):
+        self.capacity = capacity
+        self.frameSize = frameSize
+        self.written = 0        # frames appended so far
+        self._buffer = bytearray(capacity * frameSize)
+        self._view = memoryview(self._buffer)
+        self._lengths = array('I', [0]) * capacity
+
+    @property
+    def oldest(self):
+        return max(0, self.written - self.capacity)
+
+    def slot(self):
+        '''
+        :Returns:
+            - slot `memoryview`: the writable slot of the next frame, filled in place and then `commit`ted
+        '''
+        offset = (self.written % self.capacity) * self.frameSize
+        return self._view[offset:offset + self.frameSize]
+
+    def commit(self, size:int):
+        self._lengths[self.written % self.capacity] = size
+        self.written += 1
+
+    def append(self, data:bytes):
+        size = len(data)
+        if size > self.frameSize:
+            raise ValueError('Frame of {} bytes does not fit a {} bytes slot'.format(size, self.frameSize))
+        self.slot()[:size] = data
+        self.commit(size)
+
+    def get(self, index:int):
+        '''
+        The frame is copied out: its slot is written again as soon as the reader
+        moves on, while the voice client may still be encoding or sending it.
+
+        :Returns:
+            - frame `bytes`: the frame at `index`, `None` if not written yet or already overwritten
+        '''
+        if not self.oldest <= index < self.written:
+            return None
+        slot = index % self.capacity
+        offset = slot * self.frameSize
+        return bytes(self._view[offset:offset + self._lengths[slot]])
+
+
+class ReadAheadBuffer():
+    '''
+    Reads the frames of an audio source ahead of playback on a background thread,
+    so a slow read (e.g. ffmpeg waiting on the CDN) drains the buffer instead of
+    stalling the voice sender.
+
+    Frames are either returned by `read()` or, when `readinto` is given, decoded
+    straight into the ring so filling it allocates nothing per frame. Reading
+    still copies each frame once, see `FrameRing.get`.
+    '''
+
+    def __init__(self, capacity:int, frameSize:int, read=None, readinto=None):
+        self.ring = FrameRing(capacity, frameSize)
+        self.cursor = 0         # next frame handed to the player
+        self.underruns = 0      # reads that found the buffer empty
+        self.finished = False
+        self.closed = False
+        self._read = read
+        self._readinto = readinto
+        self._cond = threading.Condition()
+        threading.Thread(target=self._fill, daemon=True).start()
+
+    @property
+    def capacity(self):
+        return self.ring.capacity
+
+    @property
+    def fill(self):
+        return self.ring.written - self.cursor
+
+    def stats(self):
+        return {
+            'fill' : self.fill,
+            'capacity' : self.capacity,
+            'underruns' : self.underruns
+        }
+
+    def wait(self, frames:int, timeout:float=None):
+        '''
+        Block until `frames` frames are buffered or the source has ended
+        '''
+        with self._cond:
+            return self._cond.wait_for(lambda: self.fill >= min(frames, self.capacity) or self.finished or self.closed, timeout)
+
+    def read(self):
+        with self._cond:
+            if not self.fill and not (self.finished or self.closed):
+                self.underruns += 1
+                self._cond.wait_for(lambda: self.fill or self.finished or self.closed)
+            data = self.ring.get(self.cursor)
+            if data is None:
+                return b''
+            self.cursor += 1
+            self._cond.notify_all()
+            return data
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def _fill(self):
+        frameSize = self.ring.frameSize
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self.fill < self.capacity or self.closed)
+                if self.closed:
+                    return
+            # the slot being written is free: the reader is at least one frame ahead of it
+            if self._readinto is not None:
+                size = self._readinto(self.ring.slot())
+                # a partial PCM frame is the end of the stream
+                if size != frameSize:
+                    size = 0
+            else:
+                data = self._read()
+                size = len(data)
+                if size:
+                    self.ring.slot()[:size] = data
+            with self._cond:
+                if not size:
+                    self.finished = True
+                    self._cond.notify_all()
+                    return
+                self.ring.commit(size)
+                self._cond.notify_all()
@@ -0,0 +1,18 @@
+import json
+
+# optional faster backend, the standard library is used when it is not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = 'orjson' if orjson is not None else 'json'
+
+
+def loads(data):
+    '''
+    Decode a JSON document from `bytes` or `str` with the fastest backend installed
+    '''
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
@@ -0,0 +1,135 @@
+import os
+import re
+import json
+import asyncio
+
+
+class LoudnessCache():
+    '''
+    EBU R128 loudness of songs, measured once by ffmpeg in the background and
+    kept on disk by song id.
+
+    The measured loudness gives each song the gain that brings it to a common
+    target loudness; it is applied by the ffmpeg filter graph when the source
+    is opened, so normalisation costs nothing per frame.
+    '''
+
+    PATH = 'cache/loudness.json'
+    TARGET = -16.0          # LUFS
+    MAX_GAIN = 6.0          # dB, quiet masters are not boosted beyond this
+    PEAK_CEILING = -1.0     # dBTP a boosted song may peak at
+    CONCURRENCY = 1         # ffmpeg analyses running at the same time
+    STREAM_OPTIONS = ['-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5']
+
+    # the summary ffmpeg's ebur128 filter prints once the whole input was read
+    INTEGRATED = re.compile(rb'I:\s+(-?[\d.]+) LUFS')
+    PEAK = re.compile(rb'Peak:\s+(-?[\d.]+|-inf) dBFS')
+
+    def __init__(self, path:str=None, target:float=None):
+        self.path = path or self.PATH
+        self.target = self.TARGET if target is None else target
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.entries = {}       # song id -> (integrated loudness, true peak)
+        self._queue = None
+        self._workers = []
+        self._pending = set()
+        self._load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, id):
+        return int(id) in self.entries
+
+    def gain(self, id:int):
+        '''
+        :Returns:
+            - gain `float`: linear gain bringing the song to the target loudness, `None` if not analysed yet
+        '''
+        entry = self.entries.get(int(id))
+        if entry is None:
+            return None
+        loudness, peak = entry
+        gain = min(self.target - loudness, self.MAX_GAIN)
+        if gain > 0 and peak is not None:
+            # boost quiet songs only as far as their peaks allow
+            gain = max(0, min(gain, self.PEAK_CEILING - peak))
+        return 10 ** (gain / 20)
+
+    def schedule(self, id:int, input:str, stream:bool=False):
+        '''
+        Queue the analysis of a song unless it was measured already
+
+        :Args:
+            - id `int`: song id
+            - input `str`: path of a library file or url of the audio
+            - stream `bool`: `input` is a url
+        '''
+        id = int(id)
+        if id in self.entries or id in self._pending:
+            return
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._workers = [asyncio.ensure_future(self._worker()) for _ in range(self.CONCURRENCY)]
+        self._pending.add(id)
+        self._queue.put_nowait((id, input, stream))
+
+    def save(self):
+        '''
+        Write the cache atomically
+        '''
+        temp = self.path + '.tmp'
+        with open(temp, 'w', encoding='UTF-8') as f:
+            json.dump(self.entries, f)
+        os.replace(temp, self.path)
+
+    def close(self):
+        for worker in self._workers:
+            worker.cancel()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='UTF-8') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            print(f'ERROR: {type(e).__name__} - {e}')
+            return
+        self.entries = {int(id): tuple(entry) for id, entry in entries.items()}
+
+    async def _worker(self):
+        while True:
+            id, input, stream = await self._queue.get()
+            try:
+                await self._analyse(id, input, stream)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f'ERROR: {type(e).__name__} - {e}')
+            finally:
+                self._pending.discard(id)
+
+    async def _analyse(self, id:int, input:str, stream:bool):
+        process = await asyncio.create_subprocess_exec(
+            'ffmpeg', '-nostats', '-hide_banner',
+            *(self.STREAM_OPTIONS if stream else []),
+            '-i', input,
+            '-vn', '-af', 'ebur128=peak=true:framelog=quiet',
+            '-f', 'null', '-',
+            stdout = asyncio.subprocess.DEVNULL,
+            stderr = asyncio.subprocess.PIPE
+        )
+        _, stderr = await process.communicate()
+        loudness = self.INTEGRATED.findall(stderr)
+        if process.returncode != 0 or not loudness:
+            raise RuntimeError('Loudness analysis of song `ID:{}` failed: {}'.format(id, stderr[-500:].decode(errors='replace').strip()))
+
+        peak = self.PEAK.findall(stderr)
+        peak = float(peak[-1]) if peak and peak[-1] != b'-inf' else None
+        self.entries[id] = (float(loudness[-1]), peak)
+        self.save()
+        print('Measured song `ID:{}` at {:.1f} LUFS'.format(id, self.entries[id][0]))
@@ -0,0 +1,103 @@
+import os
+import json
+import time
+import sqlite3
+from cache import TTLCache
+
+
+class MetadataStore():
+    '''
+    Persistent store of the song records produced by `get_song`.
+
+    Records live in a SQLite database (WAL mode) so the cache survives restarts,
+    with an in-memory LRU in front of it. A record older than `maxAge` seconds
+    is treated as missing and fetched again.
+    '''
+
+    PATH = 'cache/metadata.db'
+    MAX_AGE = 7 * 24 * 3600     # seconds before a record is refreshed
+    LRU_SIZE = 4096
+    MAX_VARIABLES = 500         # ids per query, below SQLite's bound parameter limit
+
+    def __init__(self, path:str=None, maxAge:float=None, lruSize:int=None):
+        self.path = path or self.PATH
+        self.maxAge = self.MAX_AGE if maxAge is None else maxAge
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS songs ('
+            'id INTEGER PRIMARY KEY, '
+            'data TEXT NOT NULL, '
+            'updated REAL NOT NULL)'
+        )
+        # records that expired while the bot was down would otherwise stay in the file for good
+        self.purge()
+        self._lru = TTLCache(maxsize=lruSize or self.LRU_SIZE, ttl=self.maxAge)
+
+    def get_many(self, ids:list):
+        '''
+        Look up the fresh records of the given song ids
+
+        :Args:
+            - ids `list`: song ids
+        :Returns:
+            - records `dict`: song record keyed by id, missing or stale ids are left out
+        '''
+        results = {}
+        missing = []
+        for id in ids:
+            record = self._lru.get(id)
+            if record is None:
+                missing.append(id)
+            else:
+                results[id] = record
+
+        now = time.time()
+        for i in range(0, len(missing), self.MAX_VARIABLES):
+            chunk = missing[i:i + self.MAX_VARIABLES]
+            rows = self._db.execute(
+                'SELECT id, data, updated FROM songs WHERE id IN ({})'.format(','.join('?' * len(chunk))),
+                chunk
+            )
+            for id, data, updated in rows:
+                age = now - updated
+                if age >= self.maxAge:
+                    continue
+                record = self._decode(data)
+                results[id] = record
+                self._lru.set(id, record, self.maxAge - age)
+        return results
+
+    def put_many(self, records:list):
+        '''
+        Save song records returned by the api, replacing older copies
+        '''
+        now = time.time()
+        self._db.executemany(
+            'INSERT OR REPLACE INTO songs (id, data, updated) VALUES (?, ?, ?)',
+            [(record['id'], json.dumps(record, ensure_ascii=False), now) for record in records]
+        )
+        for record in records:
+            self._lru.set(record['id'], record)
+
+    def purge(self):
+        '''
+        Delete every stale record from the database
+        '''
+        self._db.execute('DELETE FROM songs WHERE updated < ?', (time.time() - self.maxAge,))
+
+    def close(self):
+        self._db.close()
+
+    @staticmethod
+    def _decode(data:str):
+        record = json.loads(data)
+        # json turns the integer bitrate keys of 'size' and 'bytes' into strings
+        record['size'] = {int(size): value for size, value in record['size'].items()}
+        if 'bytes' in record:
+            record['bytes'] = {int(size): value for size, value in record['bytes'].items()}
+        return record
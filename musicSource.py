@@ -1,37 +1,371 @@
-import os
+import audioop
 import discord
+import functools
+import threading
+import subprocess
+from collections import deque
 from discord.ext import commands
-from neteaseMusic import NeteaseMusic
+from discord.oggparse import OggStream
+from neteaseMusic import AsyncNeteaseMusic
+from qualityPolicy import QualityPolicy
+from trackRecord import TrackRecord, TrackView
+import sharedSource
+from frameBuffer import ReadAheadBuffer
+
+
+# `opus` sends ffmpeg's Opus packets as they are, `pcm` scales and encodes every frame in Python
+PLAYBACK_MODE = 'opus'
+OPUS_BITRATE = 128      # kbps
+BUFFER_SECONDS = 2      # audio read ahead of the voice sender
 
 
 class NetEaseMusicError(Exception):
     pass
 
 
-class NetEaseMusicSource(discord.PCMVolumeTransformer):
-    
-    FFMPEG_OPTIONS = {
-        'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
-        'options': '-vn',
-    }
+class TrackSource():
+    '''
+    Behaviour shared by the audio sources of a queued track: the track metadata,
+    read-ahead priming, the playback position and watching ffmpeg for http errors.
+    '''
+
+    BEFORE_OPTIONS = '-nostats'
+    STREAM_OPTIONS = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
+    OPTIONS = '-vn'
+    FRAME_LENGTH = sharedSource.FRAME_LENGTH    # seconds of audio returned by each read
+    END_TOLERANCE = 3       # seconds short of the song's duration that still count as its end
+    HTTP_ERROR = sharedSource.HTTP_ERROR
+
+    def _init_track(self, music, start:float, process:subprocess.Popen, buffer:ReadAheadBuffer=None):
+        self.music = music
+        self.requester = music.requester
+        self.channel = music.channel
+        self.data = music.data
+        self.id = music.id
+        self.start = start      # position in seconds ffmpeg was started at
+        self.frames = 0         # frames handed to the voice client
+        self._primed = deque()
+        self.httpError = None   # http status that ended the stream early, if any
+        self.interrupted = False    # the audio stopped for another reason than the end of the song
+        self.ended = False      # reads reached the end of the audio, it was not stopped
+        self.buffer = buffer
+
+        # drain ffmpeg's stderr so a rejected url can be told apart from the end of the song
+        if process is not None and process.stderr is not None:
+            threading.Thread(target=self._watch_stderr, args=(process.stderr,), daemon=True).start()
+
+    def __str__(self):
+        return str(self.music)
+
+    @property
+    def position(self):
+        return self.start + self.frames * self.FRAME_LENGTH
+
+    @property
+    def failed(self):
+        '''
+        The audio ran out before the end of the song: a rejected url, a connection
+        lost beyond ffmpeg's reconnect window, or a dropped shared decode
+        '''
+        if not self.ended:
+            return False
+        if self.httpError or self.interrupted:
+            return True
+        duration = self.music.track.duration
+        return bool(duration) and self.position + self.END_TOLERANCE < duration / 1000
 
-    def __init__(self, ctx:commands.Context, data:dict, source:discord.FFmpegPCMAudio, volume:float=0.75):
+    def _watch_stderr(self, stderr):
+        for line in stderr:
+            match = self.HTTP_ERROR.search(line)
+            if match:
+                self.httpError = int(match.group(1))
+
+    def prime(self, frames:int):
+        '''
+        Read the first frames ahead of playback so ffmpeg has already connected
+        and buffered when the track starts. Blocking, run it in an executor.
+        '''
+        if self.buffer is not None:
+            self.buffer.wait(frames)
+            return
+        while len(self._primed) < frames:
+            data = super().read()
+            if not data:
+                break
+            self._primed.append(data)
+
+    def read(self):
+        if self.buffer is not None:
+            data = self.buffer.read()
+        else:
+            data = self._primed.popleft() if self._primed else super().read()
+        if data:
+            self.frames += 1
+        else:
+            self.ended = True
+        return data
+
+    def buffer_stats(self):
+        '''
+        :Returns:
+            - stats `dict`: frames buffered ahead of playback, buffer capacity and underruns, `None` if unbuffered
+        '''
+        return self.buffer.stats() if self.buffer is not None else None
+
+    def cleanup(self):
+        self._primed.clear()
+        if self.buffer is not None:
+            self.buffer.close()
+        super().cleanup()
+
+    @classmethod
+    def before_options(cls, stream:bool, start:float=0):
+        options = cls.BEFORE_OPTIONS
+        if stream:
+            options += ' ' + cls.STREAM_OPTIONS
+        if start:
+            # input side seek, ffmpeg skips to the position without decoding up to it
+            options += ' -ss {:.2f}'.format(start)
+        return options
+
+    @classmethod
+    def options(cls, gain:float=1.0):
+        '''
+        ffmpeg output options, `gain` scales the audio inside ffmpeg's filter graph
+        '''
+        if gain == 1.0:
+            return cls.OPTIONS
+        return '{} -filter:a volume={:.3f}'.format(cls.OPTIONS, gain)
+
+
+class NetEaseMusicSource(TrackSource, discord.PCMVolumeTransformer):
+    '''
+    PCM playback: ffmpeg decodes to PCM, the volume is scaled per frame and
+    discord.py encodes every frame to Opus.
+    '''
+
+    def __init__(self, music, source:discord.FFmpegPCMAudio, volume:float=0.75, start:float=0, buffer:int=0):
         super().__init__(source, volume)
-        self.requester = ctx.author
-        self.channel = ctx.channel
-        self.data = data
-        self.id = data.get('id')
+        readAhead = None
+        if buffer:
+            # ffmpeg's output is decoded straight into the ring, the volume is applied on the way out
+            readAhead = ReadAheadBuffer(buffer, discord.opus.Encoder.FRAME_SIZE, readinto=source._stdout.readinto)
+        self._init_track(music, start, getattr(source, '_process', None), readAhead)
+
+    def read(self):
+        data = super().read()
+        if data and self.buffer is not None:
+            data = audioop.mul(data, 2, min(self._volume, 2.0))
+        return data
+
+    @classmethod
+    def open(cls, music, input:str, stream:bool, volume:float=0.75, start:float=0, buffer:int=0, gain:float=1.0, **kwargs):
+        source = discord.FFmpegPCMAudio(
+            input,
+            stderr = subprocess.PIPE,
+            before_options = cls.before_options(stream, start),
+            options = cls.options(gain)
+        )
+        return cls(music, source, volume, start, buffer=buffer)
+
+
+class NetEaseOpusSource(TrackSource, discord.FFmpegOpusAudio):
+    '''
+    Opus passthrough playback: ffmpeg produces Opus packets that discord.py
+    sends as they are, so no audio is decoded or encoded in Python.
+    The volume is an ffmpeg filter fixed when the source is opened, changing it
+    means reopening the source at its current position.
+    '''
+
+    def __init__(self, music, input:str, stream:bool, volume:float=0.75, start:float=0, bitrate:int=128, codec:str=None, buffer:int=0, gain:float=1.0):
+        self._volume = volume
+        options = self.OPTIONS
+        # a copied stream can not be filtered
+        if codec not in ('opus', 'libopus'):
+            options = self.options(volume * gain)
+        super().__init__(
+            input,
+            bitrate = bitrate,
+            codec = codec,
+            stderr = subprocess.PIPE,
+            before_options = self.before_options(stream, start),
+            options = options
+        )
+        readAhead = None
+        if buffer:
+            readAhead = ReadAheadBuffer(buffer, sharedSource.SharedSourceBroker.OPUS_FRAME_SIZE, read=super(TrackSource, self).read)
+        self._init_track(music, start, self._process, readAhead)
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value:float):
+        # only takes effect once the source is reopened
+        self._volume = value
+
+    @classmethod
+    def open(cls, music, input:str, stream:bool, volume:float=0.75, start:float=0, bitrate:int=128, buffer:int=0, gain:float=1.0, **kwargs):
+        return cls(music, input, stream, volume, start, bitrate=bitrate, buffer=buffer, gain=gain)
+
+
+class SharedTrackSource(TrackSource, sharedSource.SharedReader):
+    '''
+    A subscriber of a decode shared between every guild playing the same track,
+    see `sharedSource.SharedSourceBroker`
+    '''
+
+    def __init__(self, music, stream:sharedSource.SharedStream, volume:float=0.75, start:float=0, buffer:int=0):
+        self._init_track(music, start, None)
+        super().__init__(stream, start, volume)
+        if buffer:
+            # the shared frames are copied ahead of playback, the volume is applied on the way out
+            self.buffer = ReadAheadBuffer(buffer, stream.ring.frameSize, read=functools.partial(stream.read, self))
+
+    def read(self):
+        data = super().read()
+        if not data:
+            self.httpError = self.stream.httpError
+            self.interrupted = self.lost
+        elif self.buffer is not None:
+            data = self.scale(data)
+        return data
+
+    def buffer_stats(self):
+        if self.buffer is not None:
+            return super().buffer_stats()
+        return {
+            'fill' : max(0, self.stream.ring.written - self.cursor),
+            'capacity' : self.stream.ahead,
+            'underruns' : self.underruns
+        }
+
+    @classmethod
+    def open(cls, music, input:str, stream:bool, volume:float=0.75, start:float=0, mode:str=PLAYBACK_MODE, bitrate:int=128, buffer:int=0, gain:float=1.0, **kwargs):
+        opus = mode == 'opus'
+
+        def open_decode(offset):
+            options = {
+                'stderr' : subprocess.PIPE,
+                'before_options' : cls.before_options(stream, offset)
+            }
+            if opus:
+                return discord.FFmpegOpusAudio(input, bitrate=bitrate, options=cls.options(volume * gain), **options)
+            return discord.FFmpegPCMAudio(input, options=cls.options(gain), **options)
+
+        # Opus output has the volume baked in, so it is only shared at the same volume,
+        # the reader applies it to PCM frames
+        key = (music.songId, music.br, mode, bitrate, gain, volume if opus else None)
+        return sharedSource.broker.subscribe(
+            key, start, open_decode,
+            volume = volume,
+            reader = lambda shared, offset, volume: cls(music, shared, volume, offset, buffer=buffer)
+        )
+
+
+class OggOpusFile(discord.AudioSource):
+    '''
+    Read the Opus packets of an Ogg/Opus file without starting ffmpeg
+    '''
+
+    def __init__(self, path:str, start:float=0):
+        self._file = open(path, 'rb')
+        self._packets = OggStream(self._file).iter_packets()
+        # every packet holds 20ms, skipping packets seeks without decoding
+        for _ in range(int(start / 0.02)):
+            if not self._next_packet():
+                break
+
+    def read(self):
+        return self._next_packet()
+
+    def _next_packet(self):
+        for packet in self._packets:
+            # the identification and comment headers are not audio
+            if not packet.startswith((b'OpusHead', b'OpusTags')):
+                return packet
+        return b''
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self._file.close()
+
+
+class NetEaseOggSource(TrackSource, OggOpusFile):
+    '''
+    Plays the pre-transcoded, loudness normalised Opus copy of a library song
+    as it is stored, used while the player is at the default volume the copy
+    was made at.
+    '''
+
+    def __init__(self, music, path:str, volume:float=1.0, start:float=0):
+        super().__init__(path, start)
+        self.volume = volume
+        self._init_track(music, start, None)
+
+
+class Music:
+    '''
+    A lightweight reference to a queued track. It only holds the song metadata,
+    as a compact `TrackRecord`; the audio source is opened by `open_source`
+    when the track starts playing.
+    '''
+    __slots__ = ('track', 'id', 'songId', 'br', 'download', 'requester', 'channel', 'source')
+
+    def __init__(self, ctx:commands.Context, data:dict, songId:int=None, br=999000, download=False, requester=None, channel=None):
+        self.track = data if isinstance(data, TrackRecord) else TrackRecord.from_dict(data)
+        self.id = self.track.id
+        self.songId = songId or self.id     # id of the playable version
+        self.br = br
+        self.download = download
+        # a restored entry has no command context, only its requester and text channel
+        self.requester = requester or ctx.author
+        self.channel = channel or ctx.channel
+        self.source = None
 
     def __str__(self):
-        return '**{0[filename]}** `ID:{0[id]}`'.format(self.data)
+        return '**{0.filename}** `ID:{0.id}`'.format(self.track)
+
+    @property
+    def data(self):
+        '''
+        The song metadata in the record layout of `get_song`, built on demand
+        '''
+        return TrackView(self.track)
+
+    @classmethod
+    async def create(cls, ctx:commands.Context, songId:int, br=999000, download=False, ncm:AsyncNeteaseMusic=None):
+        '''
+        Look up a song and build a queue entry for it without touching its audio
+
+        :Args:
+            - songId `int`: song id
+            - br `int`: bitrate the track should reach, lowered to what the song is available at
+            - download `bool`: play from the local library instead of streaming
+            - ncm `AsyncNeteaseMusic`: client to share the connection pool with
+        :Returns:
+            - music `Music`: the queue entry, or `None` if the song is unavailable
+        '''
+        # share the caller's client (and its connection pool) when given
+        ncm = ncm or AsyncNeteaseMusic()
+        songs = await ncm.get_song(songId)
+        if not songs:
+            raise NetEaseMusicError('Unable to fetch the detail of song `ID:{}`'.format(songId))
+        return await cls.from_info(ctx, songs[0], br=br, download=download, ncm=ncm)
 
     @classmethod
-    async def create_source(cls, ctx:commands.Context, songId:int, br=999000, download=False):
-        ncm = NeteaseMusic()
-        info = ncm.get_song(songId)[0]
+    async def from_info(cls, ctx:commands.Context, info:dict, br=999000, download=False, ncm:AsyncNeteaseMusic=None):
+        '''
+        Build a queue entry from song metadata already returned by `get_song`
+        '''
+        ncm = ncm or AsyncNeteaseMusic()
+        songId = info['id']
 
         # song that is non-copyrighted and has no alternative version
-        if not ncm.check_song(songId) and info.get('altSongId') is None:
+        if not await ncm.check_song(songId) and info.get('altSongId') is None:
             return None
 
         # update id if there exist an alternative version of the song
@@ -39,43 +373,92 @@ class NetEaseMusicSource(discord.PCMVolumeTransformer):
             songId = int(info.get('altSongId'))
             print(f'Alternative version found! ID:{songId}')
 
-        audioInfo = ncm.get_audio_file(songId, bitrate=br)
-        print('Song info: ', info)
+        br = QualityPolicy.choose(info, br, vip=ncm.config.getboolean('config', 'vip', fallback=False))
+        return cls(ctx, info, songId, br=br, download=download)
 
-        if download:
-            filename = 'songs/%s.%s' % (info['filename'], audioInfo['type'])
-            # download the song if it does not exist
-            if not os.path.exists(filename):
-                ncm.download(songId, bitrate=320000)
-            else:
-                print('Looking up existing songs in library...')
-            return cls(ctx, info, discord.FFmpegPCMAudio(filename))
-        else:
-            print('not downloading song')
+    async def open_source(self, ncm:AsyncNeteaseMusic=None, volume:float=0.75, start:float=0):
+        '''
+        Resolve the audio of the track and open it with ffmpeg.
+        Only called once the track is about to be played, so signed urls are fresh
+        and at most one ffmpeg process is alive per voice state.
 
-        print('using url:', audioInfo['url'])
-        return cls(ctx, info, discord.FFmpegPCMAudio(audioInfo['url'], **cls.FFMPEG_OPTIONS))
+        :Args:
+            - ncm `AsyncNeteaseMusic`: client to share the connection pool with
+            - volume `float`: initial volume of the source
+            - start `float`: position in seconds to start playing from
+        :Returns:
+            - source `TrackSource`: a playable audio source, its type depends on `playback_mode`
+        '''
+        ncm = ncm or AsyncNeteaseMusic()
+        input = None
+        if self.download:
+            # a library hit plays without any request
+            input = await ncm.download(self.songId, bitrate=self.br)
+            if input is None:
+                print('Download failed, streaming {} instead'.format(self))
 
+        # loudness normalisation, applied by ffmpeg along with the volume
+        normalize = ncm.config.getboolean('config', 'normalize', fallback=True)
+        gain = ncm.loudness.gain(self.songId) if normalize else 1.0
+        # measured once in the background, the song is normalised from its next play on
+        measure = gain is None
+        gain = 1.0 if gain is None else gain
+        if measure and input is not None:
+            ncm.loudness.schedule(self.songId, input)
 
-class Music:
-    __slots__ = ('source', 'requester')
+        mode = ncm.config.get('config', 'playback_mode', fallback=PLAYBACK_MODE)
+        if input is not None and mode == 'opus':
+            # the copy is made at the song's loudness gain and the default volume
+            copyGain = ncm.opus_gain(self.songId)
+            opusInput = ncm.opus.get(self.songId, self.br, copyGain) if copyGain is not None else None
+            if opusInput is None:
+                # an unmeasured song is transcoded once its gain is known
+                if copyGain is not None:
+                    ncm.opus.schedule(self.songId, self.br, copyGain)
+            elif abs(volume * gain - copyGain) <= ncm.opus.GAIN_TOLERANCE:
+                return NetEaseOggSource(self, opusInput, volume, start)
+            else:
+                # still needs ffmpeg for another volume, but no mp3/flac decoding or resampling
+                input = opusInput
+                gain = gain / copyGain
+
+        stream = input is None
+        if stream:
+            # fall back to the other tiers when this one is unavailable or vip only
+            vip = ncm.config.getboolean('config', 'vip', fallback=False)
+            for bitrate in QualityPolicy.ladder(self.data, self.br, vip):
+                audioInfo = await ncm.get_audio_file(self.songId, bitrate=bitrate)
+                if audioInfo and audioInfo.get('url'):
+                    break
+            else:
+                raise NetEaseMusicError('Unable to fetch the audio of {}'.format(self))
+            input = audioInfo['url']
+            print('using url:', input)
+            if measure:
+                ncm.loudness.schedule(self.songId, input, stream=True)
 
-    def __init__(self, source: NetEaseMusicSource):
-        self.source = source
-        self.requester = source.requester
+        bitrate = ncm.config.getint('config', 'opus_bitrate', fallback=OPUS_BITRATE)
+        # frames read ahead of the voice sender, 0 reads the audio synchronously
+        buffer = int(ncm.config.getfloat('config', 'buffer_seconds', fallback=BUFFER_SECONDS) / TrackSource.FRAME_LENGTH)
+        if ncm.config.getboolean('config', 'shared_decode', fallback=True):
+            # guilds playing the same track read from a single ffmpeg process
+            return SharedTrackSource.open(self, input, stream, volume, start, mode=mode, bitrate=bitrate, buffer=buffer, gain=gain)
+        sourceType = NetEaseOpusSource if mode == 'opus' else NetEaseMusicSource
+        return sourceType.open(self, input, stream, volume, start, bitrate=bitrate, buffer=buffer, gain=gain)
 
     def create_embed(self):
+        track = self.track
+        artists = ' & '.join(artist.name for artist in track.artists)
         embed = (discord.Embed(title='Now playing',
-                               description='```\n{} - {}\n```'.format(self.source.data.get('title'),
-                               ' & '.join([i['name'] for i in self.source.data['artist']])),
+                               description='```\n{} - {}\n```'.format(track.title, artists),
                                color=discord.Color.blurple())
-                 .add_field(name='Artist', value=' & '.join([i['name'] for i in self.source.data['artist']]))
-                 .add_field(name='Album', value=self.source.data['album']['name'])
-                 .add_field(name='Duration', value=self.source.data.get('length'))
+                 .add_field(name='Artist', value=artists)
+                 .add_field(name='Album', value=track.album.name)
+                 .add_field(name='Duration', value=track.length)
                  .add_field(name='Requested by', value=self.requester.mention)
-                 .add_field(name='Music Page', value='[Click]({})'.format(self.source.data.get('url')))
-                 .add_field(name='ID', value=self.source.data.get('id'))
-                 .set_thumbnail(url=self.source.data['album']['picture'])
-                 .set_footer(text="Release on {}".format(self.source.data['album']['publishTime'])))
+                 .add_field(name='Music Page', value='[Click]({})'.format(track.url))
+                 .add_field(name='ID', value=track.id)
+                 .set_thumbnail(url=track.album.picture)
+                 .set_footer(text="Release on {}".format(track.album.publishTime)))
 
-        return embed
\ No newline at end of file
+        return embed
@@ -1,16 +1,52 @@
 import os
 import re
-import requests
+import asyncio
+import aiohttp
 import datetime
 from prettytable import PrettyTable
 from pprint import pprint
 from configparser import ConfigParser
-
-class NeteaseMusic():
+import jsonCodec
+from cache import TTLCache
+from metadataStore import MetadataStore
+from searchCache import SearchCache
+from songLibrary import SongLibrary
+from opusCache import OpusCache
+from loudnessCache import LoudnessCache
+
+class AsyncNeteaseMusic():
     '''
     A music object that contains the essential attributes and methods of a song.
+
+    All requests go through a single `aiohttp.ClientSession` so connections to the
+    ncmApi host are kept alive and pooled instead of being opened per call.
     '''
 
+    # connection pool and timeout defaults, overridable under [config] in config.ini
+    CONNECTION_LIMIT = 100
+    CONNECTION_LIMIT_PER_HOST = 10
+    KEEPALIVE_TIMEOUT = 30
+    TIMEOUT = 15
+    CONNECT_TIMEOUT = 5
+
+    REQUEST_TTL = 5             # seconds a response is reused for an identical request
+    RESPONSE_CACHE_SIZE = 256
+
+    # most song ids sent in one `song/detail` or `song/url` request
+    MAX_DETAIL_IDS = 500
+    MAX_URL_IDS = 200
+
+    # signed audio urls carry their expiry time (Beijing time) as the first path segment
+    URL_EXPIRY = re.compile(r'/(\d{14})/')
+    URL_EXPIRY_TZ = datetime.timezone(datetime.timedelta(hours=8))
+    URL_EXPIRY_MARGIN = 60      # seconds an url is dropped before it expires
+    URL_TTL = 900               # seconds an url is kept when it has no expiry
+    URL_CACHE_SIZE = 2048
+
+    DOWNLOAD_CHUNK = 64 * 1024
+    DOWNLOAD_RETRIES = 3
+    DOWNLOAD_READ_TIMEOUT = 30
+
     def __init__(self):
         self.config = ConfigParser()
         self.config.read("config.ini", encoding="UTF-8")
@@ -26,9 +62,150 @@ class NeteaseMusic():
             ),
             'info' : dict()
         }
+        self._session = None
 
+        # raw responses of recent requests, keyed by endpoint and parameters
+        self.responseCache = TTLCache(
+            maxsize = self.RESPONSE_CACHE_SIZE,
+            ttl = self.config.getfloat('config', 'request_ttl', fallback=self.REQUEST_TTL)
+        )
+        self._requests = {}     # same key -> request in flight
 
-    def search(self, keywords:str, limit=10, offset=0, _type=1):
+        # signed audio urls keyed by (song id, bitrate)
+        self.urlCache = TTLCache(
+            maxsize = self.URL_CACHE_SIZE,
+            ttl = self.config.getfloat('config', 'url_ttl', fallback=self.URL_TTL)
+        )
+        self._urlLookups = {}   # (song id, bitrate) -> lookup in flight
+
+        self.searchCache = SearchCache(ttl=self.config.getfloat('config', 'search_ttl', fallback=SearchCache.TTL))
+
+        # the on-disk stores below are opened on first use, a one-off lookup creates no files
+        self._library = None
+        self._opus = None
+        self._loudness = None
+        self._metadata = None
+        self._downloads = {}    # library key -> download in flight
+        self._downloadProgress = {}     # library key -> progress callbacks of that download
+
+
+    @property
+    def library(self):
+        # downloaded songs, see `download`
+        if self._library is None:
+            self._library = SongLibrary(
+                path = self.config.get('config', 'library_path', fallback=SongLibrary.PATH),
+                maxBytes = self.config.getint('config', 'library_max_bytes', fallback=SongLibrary.MAX_BYTES)
+            )
+        return self._library
+
+    @property
+    def opus(self):
+        if self._opus is None:
+            self._opus = OpusCache(
+                self.library,
+                path = self.config.get('config', 'opus_cache_path', fallback=OpusCache.PATH),
+                maxBytes = self.config.getint('config', 'opus_cache_max_bytes', fallback=OpusCache.MAX_BYTES)
+            )
+        return self._opus
+
+    @property
+    def loudness(self):
+        # measured loudness of played and downloaded songs, for volume normalisation
+        if self._loudness is None:
+            self._loudness = LoudnessCache(
+                path = self.config.get('config', 'loudness_cache', fallback=LoudnessCache.PATH),
+                target = self.config.getfloat('config', 'loudness_target', fallback=LoudnessCache.TARGET)
+            )
+        return self._loudness
+
+    @property
+    def metadata(self):
+        # song records of `get_song`, kept across restarts
+        if self._metadata is None:
+            self._metadata = MetadataStore(
+                path = self.config.get('config', 'metadata_db', fallback=MetadataStore.PATH),
+                maxAge = self.config.getfloat('config', 'metadata_max_age', fallback=MetadataStore.MAX_AGE)
+            )
+        return self._metadata
+
+
+    async def get_session(self):
+        '''
+        Return the shared client session, creating it on first use
+
+        :Returns:
+            - session `aiohttp.ClientSession`: pooled keep-alive session for every request
+        '''
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit = self.config.getint('config', 'http_limit', fallback=self.CONNECTION_LIMIT),
+                limit_per_host = self.config.getint('config', 'http_limit_per_host', fallback=self.CONNECTION_LIMIT_PER_HOST),
+                keepalive_timeout = self.KEEPALIVE_TIMEOUT
+            )
+            timeout = aiohttp.ClientTimeout(
+                total = self.config.getfloat('config', 'http_timeout', fallback=self.TIMEOUT),
+                connect = self.CONNECT_TIMEOUT
+            )
+            self._session = aiohttp.ClientSession(headers=self.headers, connector=connector, timeout=timeout)
+        return self._session
+
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        # only the stores that were opened
+        for store in (self._library, self._opus, self._loudness, self._metadata):
+            if store is not None:
+                store.close()
+
+
+    async def _request(self, endpoint:str, params:dict=None, coalesce=True, reuse=True):
+        '''
+        Send a GET request to the ncmApi and return the decoded response body.
+        Identical requests in flight share one upstream call, and a response is
+        reused for `REQUEST_TTL` seconds, e.g. by the several lookups of one command.
+        The body is parsed once per upstream call, callers must not modify it.
+
+        :Args:
+            - endpoint `str`: api path relative to `baseUrl` (e.g. `song/detail`)
+            - params `dict`: query parameters
+            - coalesce `bool`: `False` for requests with side effects, which are always sent
+            - reuse `bool`: `False` to only share requests in flight, for responses cached
+                elsewhere that must be fetched again once invalidated (signed urls)
+        :Returns:
+            - resp `dict`: decoded JSON body
+        '''
+        if not coalesce:
+            return await self._send(endpoint, params)
+
+        key = (endpoint, tuple(sorted((name, str(value)) for name, value in (params or {}).items())))
+        resp = self.responseCache.get(key) if reuse else None
+        if resp is not None:
+            return resp
+
+        request = self._requests.get(key)
+        if request is None:
+            request = asyncio.ensure_future(self._send(endpoint, params))
+            self._requests[key] = request
+
+            def done(task):
+                self._requests.pop(key, None)
+                if reuse and not task.cancelled() and task.exception() is None:
+                    self.responseCache.set(key, task.result())
+            request.add_done_callback(done)
+        # shielded so one cancelled caller does not cancel the others
+        return await asyncio.shield(request)
+
+
+    async def _send(self, endpoint:str, params:dict=None):
+        session = await self.get_session()
+        async with session.get('{}{}'.format(self.baseUrl, endpoint), params=params) as resp:
+            return jsonCodec.loads(await resp.read())
+
+
+    async def search(self, keywords:str, limit=10, offset=0, _type=1):
         '''
         Search for music base on keywords. Precise search if 'type' is supplied\n
         Types: 1: 单曲, 10: 专辑, 100: 歌手, 1000: 歌单, 1002: 用户, 1004: MV, 1006: 歌词, 1009: 电台, 1014: 视频, 1018:综合
@@ -41,23 +218,28 @@ class NeteaseMusic():
         :Returns:
             - musicMetadata `dict`: metadata about the song (include artists, album, and length etc.)
         '''
+        musicMetadata = self.searchCache.get(keywords, limit, offset, _type)
+        if musicMetadata is not None:
+            self.musicMetadata = musicMetadata
+            return musicMetadata
+
         params = {
             'keywords' : keywords,
             'limit' : limit,
             'offset' : offset,
             'type' : _type
         }
-        resp = requests.get(
-            '{}search'.format(self.baseUrl),
-            headers=self.headers,
-            params=params
-        ).json()
+        resp = await self._request('search', params)
         songs = resp['result']['songs']     # obtain data for songs
 
-        self.musicMetadata['query'].update(
-            total = resp['result']['songCount'] if resp['result']['songCount'] > 0 else len(songs),
-            numDisplayed = len(songs)
-        )
+        # build a fresh result per call since the client is shared between guilds
+        musicMetadata = {
+            'query' : dict(
+                total = resp['result']['songCount'] if resp['result']['songCount'] > 0 else len(songs),
+                numDisplayed = len(songs)
+            ),
+            'info' : dict()
+        }
 
         results = []
         convert = lambda t: datetime.datetime.fromtimestamp(t/1000).strftime('%Y-%m-%d %H:%M:%S')
@@ -83,12 +265,14 @@ class NeteaseMusic():
 
             results.append(result)       # save each song info to a list
         # save the list the song info to the dictionary
-        self.musicMetadata.update(info = results)
+        musicMetadata.update(info = results)
+        self.musicMetadata = musicMetadata
+        self.searchCache.set(keywords, limit, offset, _type, musicMetadata)
 
-        return self.musicMetadata
+        return musicMetadata
 
 
-    def search_by_url(self, url:str):
+    async def search_by_url(self, url:str):
         '''
         Search the metadata of the song given by its url or id
 
@@ -103,7 +287,7 @@ class NeteaseMusic():
         if not isinstance(id, int):
             id = re.findall(r'\Wid=(\d+)', url)[0]
         try:
-            musicMetaData = self.get_song(id)
+            musicMetaData = await self.get_song(id)
 
             if musicMetaData is None:
                 raise ValueError('Invalid! Please double check your url link or song ID.')
@@ -113,15 +297,32 @@ class NeteaseMusic():
             return musicMetaData[0]
 
 
-    def get_audio_file(self, id:int, bitrate=999000):
+    async def get_audio_file(self, id:int, bitrate=999000):
         '''
-        Retrieve the metadata of the song file (id, url, bitrate, size, type, quality, and fee)
+        Retrieve the metadata of the song file (id, url, bitrate, size, type, quality, and fee).
+        The result is cached until its signed url expires, and concurrent lookups
+        of the same song and bitrate share one request.
 
         :Args: 
             - id `int`: song id of the song
         :Returns:
             - metaData `dict`: detail data of the song file
         '''
+        key = (int(id), bitrate)
+        metaData = self.urlCache.get(key)
+        if metaData is not None:
+            return metaData
+
+        lookup = self._urlLookups.get(key)
+        if lookup is None:
+            lookup = asyncio.ensure_future(self._fetch_audio_file(id, bitrate))
+            self._urlLookups[key] = lookup
+            lookup.add_done_callback(lambda _: self._urlLookups.pop(key, None))
+        # shielded so one cancelled caller does not cancel the others
+        return await asyncio.shield(lookup)
+
+
+    async def _fetch_audio_file(self, id:int, bitrate:int):
         params = {
             'id' : id,
             'br' : bitrate
@@ -129,11 +330,8 @@ class NeteaseMusic():
 
         try:
             # get the current song info
-            resp = requests.get(
-                '{}song/url'.format(self.baseUrl),
-                headers = self.headers,
-                params = params
-            ).json()
+            # `urlCache` keeps the url until it expires or is invalidated, a rejected one must not come back
+            resp = await self._request('song/url', params, reuse=False)
 
             # validate status code
             if resp['code'] != 200 or resp['data'][0]['code'] != 200:
@@ -141,19 +339,146 @@ class NeteaseMusic():
         except Exception as e:
             print(f'ERROR: {type(e).__name__} - {e}')
         else:
-            song = resp['data'][0]
-            metaData = {
-                'id' : id,
-                'url' : song['url'],
-                'bitrate' : int(song['br'] / 1000),
-                'size' : '%.1f MB' % (song['size']/1_000_000),   # convert each bitrates to megabytes
-                'type' : song['type'],
-                'quality' : song['level'],
-                'fee' : 'vip only' if song['fee'] == 1 else 'free'
-            }
+            metaData = self._audio_metadata(id, resp['data'][0])
+            self._cache_audio_file(int(id), bitrate, metaData)
             return metaData
-    
-    def check_song(self, _id):
+
+
+    def _cache_audio_file(self, id:int, bitrate:int, metaData:dict):
+        if not metaData['url']:
+            return
+        ttl = self.urlCache.ttl
+        match = self.URL_EXPIRY.search(metaData['url'])
+        if match:
+            expiry = datetime.datetime.strptime(match.group(1), '%Y%m%d%H%M%S').replace(tzinfo=self.URL_EXPIRY_TZ)
+            remaining = (expiry - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+            ttl = min(ttl, remaining - self.URL_EXPIRY_MARGIN)
+        self.urlCache.set((id, bitrate), metaData, ttl)
+
+
+    def invalidate_audio_file(self, id:int, bitrate=999000):
+        '''
+        Drop the cached url of a song, e.g. after the cdn rejected it
+        '''
+        self.urlCache.pop((int(id), bitrate))
+
+
+    def _audio_metadata(self, id:int, song:dict):
+        metaData = {
+            'id' : id,
+            'url' : song['url'],
+            'bitrate' : int(song['br'] / 1000),
+            'size' : '%.1f MB' % (song['size']/1_000_000),   # convert each bitrates to megabytes
+            'bytes' : song['size'],
+            'type' : song['type'],
+            'quality' : song['level'],
+            'fee' : 'vip only' if song['fee'] == 1 else 'free'
+        }
+        return metaData
+
+
+    @staticmethod
+    def _chunks(ids:list, size:int):
+        ids = list(ids)
+        for i in range(0, len(ids), size):
+            yield ids[i:i + size]
+
+
+    async def _get_song_urls(self, ids:list, bitrate:int):
+        '''
+        Request `song/url` for many songs at once, `MAX_URL_IDS` per request
+
+        :Returns:
+            - data `dict`: raw `song/url` entry keyed by song id
+        '''
+        data = {}
+        for chunk in self._chunks(ids, self.MAX_URL_IDS):
+            try:
+                resp = await self._request('song/url', {'id' : ','.join(map(str, chunk)), 'br' : bitrate}, reuse=False)
+                if resp['code'] != 200:
+                    raise ValueError('Invalid! Please double check your song IDs.')
+            except Exception as e:
+                print(f'ERROR: {type(e).__name__} - {e}')
+            else:
+                for song in resp['data']:
+                    data[song['id']] = song
+        return data
+
+
+    async def get_audio_files(self, ids:list, bitrate=999000):
+        '''
+        Retrieve the metadata of the song files of many songs with as few requests as possible
+
+        :Args:
+            - ids `list`: song ids
+            - bitrate `int`: requested bitrate
+        :Returns:
+            - metaData `dict`: detail data of each song file keyed by song id, `None` if unavailable
+        '''
+        ids = [int(i) for i in ids]
+        results = {}
+        for id in ids:
+            metaData = self.urlCache.get((id, bitrate))
+            if metaData is not None:
+                results[id] = metaData
+
+        data = await self._get_song_urls([id for id in ids if id not in results], bitrate)
+        for id in ids:
+            if id in results:
+                continue
+            song = data.get(id)
+            if song is None or song['code'] != 200 or not song['url']:
+                results[id] = None
+            else:
+                results[id] = self._audio_metadata(id, song)
+                self._cache_audio_file(id, bitrate, results[id])
+        return results
+
+
+    async def check_songs(self, ids:list):
+        '''
+        Check if the songs are available, the batched version of `check_song`
+
+        :Args:
+            - ids `list`: song ids
+        :Returns:
+            - isAvailable `dict`: `True` for each song id that has copyright, `False` otherwise
+        '''
+        # `check/music` only takes one id, it is a `song/url` lookup at the highest bitrate,
+        # whose urls are kept in `urlCache` for the playback that usually follows the check
+        files = await self.get_audio_files(ids, 999000)
+        return {id: metaData is not None for id, metaData in files.items()}
+
+
+    async def resolve_songs(self, songs:list):
+        '''
+        Find the playable id of each song, following `altSongId` when a song has no copyright
+
+        :Args:
+            - songs `list`: song metadata returned by `get_song`
+        :Returns:
+            - playable `dict`: playable song id (itself or its alternative version) keyed by song id, `None` if unavailable
+        '''
+        available = await self.check_songs([song['id'] for song in songs])
+        alternatives = {
+            song['id'] : int(song['altSongId'])
+            for song in songs if not available[song['id']] and song.get('altSongId')
+        }
+        if alternatives:
+            available.update(await self.check_songs(alternatives.values()))
+
+        results = {}
+        for song in songs:
+            songId = song['id']
+            if available[songId]:
+                results[songId] = songId
+            elif songId in alternatives and available[alternatives[songId]]:
+                results[songId] = alternatives[songId]
+            else:
+                results[songId] = None
+        return results
+
+    async def check_song(self, _id):
         '''
         Check if the song is available
 
@@ -162,92 +487,88 @@ class NeteaseMusic():
         :Returns:
             - isAvailable `boolean`: `True` if this song has copyright, `False` otherwise
         '''        
-        resp = requests.get(
-            '{}check/music'.format(self.baseUrl),
-            headers = self.headers,
-            params = {'id' : _id}
-        ).json()
+        resp = await self._request('check/music', {'id' : _id})
 
         return resp.get('success')
 
-    def get_song(self, ids):
+    async def get_song(self, ids):
         '''
-        Get the detail infomation of the given song
+        Get the detail infomation of the given song.
+        Fresh records are served from the local metadata store and only the
+        missing ids are requested from the api.
 
         :Args:
             - ids `int`: song IDs
         :Returns:
             - results `list`: metadata about the song(s) (include artists, album, and length etc.)
         '''
-        # concatenate to a string with comma seperation if it is a list
-        if isinstance(ids, list):
-            ids = ','.join(map(str,ids))
+        # accept a single id, a comma separated string or a list of ids
+        if isinstance(ids, (list, tuple)):
+            ids = [int(i) for i in ids]
+        else:
+            ids = [int(i) for i in str(ids).split(',') if i.strip()]
+
+        records = self.metadata.get_many(ids)
+        missing = [id for id in dict.fromkeys(ids) if id not in records]
+        # split long id lists across several requests
+        for chunk in self._chunks(missing, self.MAX_DETAIL_IDS):
+            songs = await self._fetch_songs(chunk)
+            if songs:
+                self.metadata.put_many(songs)
+                records.update((song['id'], song) for song in songs)
+
+        results = [records[id] for id in ids if id in records]
+        return results or None
 
+
+    async def _fetch_songs(self, ids:list):
+        ids = ','.join(map(str,ids))
         try:
-            resp = requests.get(
-                '{}song/detail'.format(self.baseUrl),
-                headers = self.headers,
-                params = {
-                    'ids' : ids
-                }
-            )
-            songs = resp.json()['songs']
+            resp = await self._request('song/detail', {'ids' : ids})
+            songs = resp.get('songs')
             # validate song id by checking if the list is empty
-            if '"code":400' in resp.text or "Internal Server Error" in resp.text or not songs:
+            if resp.get('code') != 200 or not songs:
                 raise ValueError('Invalid! Please double check your song ID.')
         except Exception as e:
             print(f'ERROR: {type(e).__name__} - {e}')
         else:
-            results = []
-            for i in range(len(songs)):
-                song = songs[i]
-                privilege = resp.json()['privileges'][i]
-
-                # some songs may not have all available bitrates data
-                sizes = {
-                    128000: song.get('l').get('size') if song.get('l') is not None else 0,
-                    192000: song.get('m').get('size') if song.get('m') is not None else 0,
-                    320000: song.get('h').get('size') if song.get('h') is not None else 0
-                }
-                    
-                result = {
-                    'title': song['name'],
-                    'artist': [dict(name= artist['name'], id= artist['id']) for artist in song['ar']],
-                    'album': {
-                        'name': song['al']['name'],
-                        'id': song['al']['id'],
-                        'picture': song['al']['picUrl'],
-                        'publishTime': self.timeConvert(song['publishTime']) if song['publishTime'] > 0 else "N/A"
-                    },
-                    'length': '%02d:%02d' %(divmod(song['dt']/1000,60)),                                    # convert ms to seconds
-                    'id': song['id'],
-                    'size': {size:'{:.1f} MB'.format(value/1_000_000) for size, value in sizes.items()},    # convert each bitrates to megabytes
-                    'fee' : '',
-                    'maxBitrate' : privilege['maxbr'],
-                    'url': 'https://music.163.com/#/song?id=%s' % song['id'],
-                    'altSongId' : song['noCopyrightRcmd']['songId'] if song.get('noCopyrightRcmd') else None # song id (str) of other available version
-                }
+            return [self._song_record(song, privilege) for song, privilege in zip(songs, resp['privileges'])]
 
-                # update fee infomation
-                if privilege['fee'] == 1:
-                    result.update(fee='Vip Only')
-                elif privilege['fee'] > 1:
-                    result.update(fee='low bitrate free')
-                else:
-                    result.update(fee='free')
-
-                # the filename contains all of the artist names
-                names = ' & '.join([i['name'] for i in result['artist']])
-                filename = '%s - %s' % (names, result['title'])
-                # save the audio file name
-                result.update(filename=filename)
 
-                # save each song info to a list
-                results.append(result)
-            return results
+    def _song_record(self, song:dict, privilege:dict):
+        '''
+        Normalize one track of a `song/detail` response, reading only the fields the bot uses
+        '''
+        # some songs may not have all available bitrates data
+        sizes = {bitrate: (song.get(level) or {}).get('size', 0) for bitrate, level in ((128000, 'l'), (192000, 'm'), (320000, 'h'))}
+        artists = [dict(name= artist['name'], id= artist['id']) for artist in song['ar']]
+        album = song['al']
+        fee = privilege['fee']
+        title = song['name']
+        return {
+            'title': title,
+            'artist': artists,
+            'album': {
+                'name': album['name'],
+                'id': album['id'],
+                'picture': album['picUrl'],
+                'publishTime': self.timeConvert(song['publishTime']) if song['publishTime'] > 0 else "N/A"
+            },
+            'length': '%02d:%02d' %(divmod(song['dt']/1000,60)),                                    # convert ms to seconds
+            'duration': song['dt'],                                                                 # in ms
+            'id': song['id'],
+            'size': {size:'{:.1f} MB'.format(value/1_000_000) for size, value in sizes.items()},    # convert each bitrates to megabytes
+            'bytes': sizes,                                                                         # exact size of each bitrate
+            'fee' : 'Vip Only' if fee == 1 else 'low bitrate free' if fee > 1 else 'free',
+            'maxBitrate' : privilege['maxbr'],
+            'url': 'https://music.163.com/#/song?id=%s' % song['id'],
+            'altSongId' : song['noCopyrightRcmd']['songId'] if song.get('noCopyrightRcmd') else None, # song id (str) of other available version
+            # the filename contains all of the artist names
+            'filename': '%s - %s' % (' & '.join(artist['name'] for artist in artists), title)
+        }
 
 
-    def get_playlist(self, url:str):
+    async def get_playlist(self, url:str):
         '''
         Get the detail infomation of the given playlist
 
@@ -263,13 +584,7 @@ class NeteaseMusic():
         if not isinstance(pid, int):
             pid = re.findall(r'\Wid=(\d+)', url)[0]
         try:
-            resp = requests.get(
-                '{}playlist/detail'.format(self.baseUrl),
-                headers = self.headers,
-                params = {
-                    'id' : pid
-                }
-            ).json()
+            resp = await self._request('playlist/detail', {'id' : pid})
             # validate playlist id
             if resp['code'] != 200:
                 raise ValueError('Invalid! Please double check your playlist ID.')
@@ -317,22 +632,15 @@ class NeteaseMusic():
             }
 
             # add tracks id in the playlist
-            for track in playlist['trackIds']:
-                result['playlist']['trackIds'].append(track['id'])
+            result['playlist']['trackIds'] = [track['id'] for track in playlist['trackIds']]
             
             return result
 
 
-    def get_lyric(self, id:int):
+    async def get_lyric(self, id:int):
         # assuing the given song has lyric
         try:
-            resp = requests.get(
-                '{}lyric'.format(self.baseUrl),
-                headers = self.headers,
-                params = {
-                    'id' : id
-                }
-            ).json()
+            resp = await self._request('lyric', {'id' : id})
             
             # validate song id
             if resp.get('nolyric'):
@@ -446,7 +754,7 @@ class NeteaseMusic():
         return results
 
 
-    def get_hot_comments(self, id:int, _type=0, limit=20, offset=0):
+    async def get_hot_comments(self, id:int, _type=0, limit=20, offset=0):
         # 0:song, 1:mv, 2:playlist, 3:album, 4:radio, 5:video
 
         params = {
@@ -456,11 +764,7 @@ class NeteaseMusic():
             'type' : _type
         }
         try:
-            resp = requests.get(
-                '{}comment/hot'.format(self.baseUrl),
-                headers=self.headers,
-                params=params
-            ).json()
+            resp = await self._request('comment/hot', params)
 
             if resp['code'] != 200:
                 raise ValueError('Invalid! Please double check your song ID.')
@@ -477,18 +781,14 @@ class NeteaseMusic():
             return results
 
 
-    def get_music_comments(self, id:int, limit=20, offset=0, isHotComment=True):
+    async def get_music_comments(self, id:int, limit=20, offset=0, isHotComment=True):
         params = {
             'id' : id,
             'limit' : limit,
             'offset' : offset
         }
         try:
-            resp = requests.get(
-                '{}comment/music'.format(self.baseUrl),
-                headers=self.headers,
-                params=params
-            ).json()
+            resp = await self._request('comment/music', params)
 
             if resp['code'] != 200:
                 raise ValueError('Invalid! Please double check your song ID.')
@@ -507,7 +807,7 @@ class NeteaseMusic():
             return results
 
 
-    def set_like_to_comment(self, id:int, cid:int, toLike=True, _type=0):
+    async def set_like_to_comment(self, id:int, cid:int, toLike=True, _type=0):
         params = {
             'id' : id,
             'cid' : cid,
@@ -515,42 +815,139 @@ class NeteaseMusic():
             'type' : _type
         }
         try:
-            resp = requests.get(
-                '{}comment/like'.format(self.baseUrl),
-                headers=self.headers,
-                params=params
-            ).json()
+            resp = await self._request('comment/like', params, coalesce=False)
         except Exception as e:
             print(f'ERROR: {type(e).__name__} - {e}')
         else:
             return "Sucess!" if resp['code'] == 200 else 'Fail!'
 
 
-    def download(self, id:int, bitrate=999000):
-        # get the detail info of the song
-        song = self.get_song(id)[0]
-        print("Music infomation of {} is obtained!".format(song['filename']))
-
-        # get the info of the music file
-        fileData = self.get_audio_file(song['id'], bitrate=bitrate)
-        try:
-            filename = '{}.{}'.format(song['filename'], fileData['type'])
-            print("{} is downloading...".format(filename))
-            # get the binary data from the download link
-            data = requests.get(fileData['url'], headers = self.headers).content
-
-            # create a new directory if haven't done so
-            fileDir = 'songs/'
-            if not os.path.exists(fileDir):
-                os.mkdir(fileDir)
+    async def download(self, id:int, bitrate=999000, progress=None):
+        '''
+        Download a song into the song library, sharing a download already in progress
 
-            with open('%s%s' % (fileDir, filename), 'wb') as f:
-                f.write(data)
-            print("{} in {} download completed!".format(filename, fileData['size']))
+        :Args:
+            - id `int`: song id
+            - bitrate `int`: requested bitrate, the library keeps one file per id and bitrate
+            - progress `coroutine function`: awaited as `progress(received, total)` in bytes while downloading
+        :Returns:
+            - path `str`: path of the audio file in the library
+        '''
+        path = self.library.get(id, bitrate)
+        if path is not None:
+            return path
+
+        key = SongLibrary.key(id, bitrate)
+        listeners = self._downloadProgress.setdefault(key, [])
+        if progress is not None:
+            listeners.append(progress)
+
+        download = self._downloads.get(key)
+        if download is None:
+            download = asyncio.ensure_future(self._download(id, bitrate, listeners))
+            self._downloads[key] = download
+
+            def done(_):
+                self._downloads.pop(key, None)
+                self._downloadProgress.pop(key, None)
+            download.add_done_callback(done)
+        return await asyncio.shield(download)
+
+
+    async def _download(self, id:int, bitrate:int, listeners:list):
+        tempPath = None
+        for attempt in range(1, self.DOWNLOAD_RETRIES + 1):
+            # get the info of the music file
+            fileData = await self.get_audio_file(id, bitrate=bitrate)
+            try:
+                if not fileData or not fileData['url']:
+                    raise ValueError('Invalid! Song `ID:{}` can not be downloaded.'.format(id))
+                path = self.library.temp_path(id, bitrate, fileData['type'])
+                if tempPath is not None and tempPath != path:
+                    # a fresh url of another type can not resume the earlier partial file
+                    self.library.discard(tempPath)
+                tempPath = path
+                print("{} is downloading...".format(tempPath))
+                await self._stream_to_file(fileData['url'], tempPath, fileData['bytes'], listeners)
+
+                path = self.library.add(id, bitrate, fileData['type'], tempPath)
+                print("{} in {} download completed!".format(path, fileData['size']))
+                # an unmeasured song is transcoded on a later play
+                gain = self.opus_gain(id)
+                if gain is not None:
+                    self.opus.schedule(id, bitrate, gain)
+                self.loudness.schedule(id, path)
+                return path
+            except aiohttp.ClientResponseError as e:
+                print(f'ERROR: {type(e).__name__} - {e}')
+                # the signed url expired, resolve a new one for the next attempt
+                if e.status in (403, 404):
+                    self.invalidate_audio_file(id, bitrate)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # the partial file is kept and resumed by the next attempt
+                print(f'ERROR: {type(e).__name__} - {e} (attempt {attempt}/{self.DOWNLOAD_RETRIES})')
+            except Exception as e:
+                print(f'ERROR: {type(e).__name__} - {e}')
+                break
+        # the download failed for good, its partial file would never be resumed or evicted
+        if tempPath is not None:
+            self.library.discard(tempPath)
+        return None
+
+
+    async def _stream_to_file(self, url:str, path:str, expected:int, listeners:list):
+        '''
+        Stream a file to disk in chunks, resuming a partial file with an HTTP Range request
+        '''
+        loop = asyncio.get_event_loop()
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        if offset > expected:
+            offset = 0
+        headers = {'Range' : 'bytes={}-'.format(offset)} if offset else {}
+
+        session = await self.get_session()
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=self.DOWNLOAD_READ_TIMEOUT)
+        async with session.get(url, headers=headers, timeout=timeout) as resp:
+            if resp.status == 416 and offset == expected:
+                return      # the partial file is already complete
+            resp.raise_for_status()
+            if offset and resp.status != 206:
+                offset = 0  # the server ignored the range, start over
+
+            received = offset
+            f = await loop.run_in_executor(None, open, path, 'ab' if offset else 'wb')
+            try:
+                async for chunk in resp.content.iter_chunked(self.DOWNLOAD_CHUNK):
+                    # keep the disk writes off the event loop
+                    await loop.run_in_executor(None, f.write, chunk)
+                    received += len(chunk)
+                    for progress in list(listeners):
+                        try:
+                            await progress(received, expected)
+                        except Exception as e:
+                            # a failing listener, e.g. its message was deleted, must not fail the download it shares
+                            print(f'ERROR: {type(e).__name__} - {e}')
+                            listeners.remove(progress)
+            finally:
+                await loop.run_in_executor(None, f.close)
+
+        if received != expected:
+            raise aiohttp.ClientPayloadError('Incomplete download: {} of {} bytes'.format(received, expected))
+
+
+    def opus_gain(self, id:int):
+        '''
+        Gain the Opus copy of a song is transcoded at: its loudness gain at the
+        default player volume, so the copy plays as it is stored in every guild
+        that did not change the volume
 
-            return filename
-        except Exception as e:
-            print(f'ERROR: {type(e).__name__} - {e}')
+        :Returns:
+            - gain `float`: linear gain, `None` if the loudness of the song was not measured yet
+        '''
+        gain = self.loudness.gain(id) if self.config.getboolean('config', 'normalize', fallback=True) else 1.0
+        if gain is None:
+            return None
+        return gain * self.config.getfloat('config', 'volume', fallback=0.75)
 
 
     def display(self):
@@ -578,18 +975,92 @@ class NeteaseMusic():
         return table
 
 
-    def login(self):
-        resp = requests.get(
-            '{}login/status'.format(self.baseUrl),
-            headers = self.headers
-        )
-        print(resp.status_code)
+    async def login(self):
+        session = await self.get_session()
+        async with session.get('{}login/status'.format(self.baseUrl)) as resp:
+            print(resp.status)
 
 
     def timeConvert(self, timestamps:int):
         return datetime.datetime.fromtimestamp(timestamps/1000).strftime('%Y-%m-%d %H:%M:%S')
 
 
+class NeteaseMusic():
+    '''
+    Blocking wrapper around `AsyncNeteaseMusic` for scripts and the console.
+    The bot itself should await `AsyncNeteaseMusic` directly.
+    '''
+
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._client = AsyncNeteaseMusic()
+        self.config = self._client.config
+        self.headers = self._client.headers
+        self.baseUrl = self._client.baseUrl
+
+    def _run(self, coro):
+        return self._loop.run_until_complete(coro)
+
+    @property
+    def musicMetadata(self):
+        return self._client.musicMetadata
+
+    def search(self, keywords:str, limit=10, offset=0, _type=1):
+        return self._run(self._client.search(keywords, limit=limit, offset=offset, _type=_type))
+
+    def search_by_url(self, url:str):
+        return self._run(self._client.search_by_url(url))
+
+    def get_audio_file(self, id:int, bitrate=999000):
+        return self._run(self._client.get_audio_file(id, bitrate=bitrate))
+
+    def get_audio_files(self, ids:list, bitrate=999000):
+        return self._run(self._client.get_audio_files(ids, bitrate=bitrate))
+
+    def check_song(self, _id):
+        return self._run(self._client.check_song(_id))
+
+    def check_songs(self, ids:list):
+        return self._run(self._client.check_songs(ids))
+
+    def resolve_songs(self, songs:list):
+        return self._run(self._client.resolve_songs(songs))
+
+    def get_song(self, ids):
+        return self._run(self._client.get_song(ids))
+
+    def get_playlist(self, url:str):
+        return self._run(self._client.get_playlist(url))
+
+    def get_lyric(self, id:int):
+        return self._run(self._client.get_lyric(id))
+
+    def get_hot_comments(self, id:int, _type=0, limit=20, offset=0):
+        return self._run(self._client.get_hot_comments(id, _type=_type, limit=limit, offset=offset))
+
+    def get_music_comments(self, id:int, limit=20, offset=0, isHotComment=True):
+        return self._run(self._client.get_music_comments(id, limit=limit, offset=offset, isHotComment=isHotComment))
+
+    def set_like_to_comment(self, id:int, cid:int, toLike=True, _type=0):
+        return self._run(self._client.set_like_to_comment(id, cid, toLike=toLike, _type=_type))
+
+    def download(self, id:int, bitrate=999000, progress=None):
+        return self._run(self._client.download(id, bitrate=bitrate, progress=progress))
+
+    def display(self):
+        return self._client.display()
+
+    def login(self):
+        return self._run(self._client.login())
+
+    def timeConvert(self, timestamps:int):
+        return self._client.timeConvert(timestamps)
+
+    def close(self):
+        self._run(self._client.close())
+        self._loop.close()
+
+
 if __name__ == "__main__":
     nm = NeteaseMusic()
 
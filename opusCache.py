@@ -0,0 +1,98 @@
+import os
+import asyncio
+from songLibrary import SongLibrary
+
+
+class OpusCache():
+    '''
+    48 kHz Ogg/Opus copies of the songs in the song library.
+
+    Library entries are transcoded once in the background, later plays send the
+    Opus packets of the copy straight to the voice client. The loudness gain of
+    the song and the default volume are applied by the transcode (see
+    `AsyncNeteaseMusic.opus_gain`), a copy made at another gain is made again. The copies are kept in their own size-bounded `SongLibrary`; a song
+    without a copy plays from its original file.
+    '''
+
+    PATH = 'songs/opus/'
+    MAX_BYTES = 1024 ** 3       # 1 GiB
+    BITRATE = 128               # kbps
+    CONCURRENCY = 1             # ffmpeg transcodes running at the same time
+    GAIN_TOLERANCE = 0.01       # linear gain difference of a copy still played as is, about 0.1 dB
+
+    def __init__(self, library:SongLibrary, path:str=None, maxBytes:int=None, bitrate:int=None):
+        self.library = library
+        self.files = SongLibrary(path or self.PATH, self.MAX_BYTES if maxBytes is None else maxBytes)
+        self.bitrate = bitrate or self.BITRATE
+
+        self._queue = None
+        self._workers = []
+        self._pending = set()
+
+    def get(self, id:int, bitrate:int, gain:float=1.0):
+        '''
+        :Returns:
+            - path `str`: path of the Ogg/Opus copy, `None` if the song has not been transcoded at `gain` yet
+        '''
+        if not self._has(SongLibrary.key(id, bitrate), gain):
+            return None
+        return self.files.get(id, bitrate)
+
+    def schedule(self, id:int, bitrate:int, gain:float=1.0):
+        '''
+        Queue a library song for transcoding unless it already has a copy at `gain`
+        '''
+        key = SongLibrary.key(id, bitrate)
+        if self._has(key, gain) or key in self._pending or key not in self.library:
+            return
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._workers = [asyncio.ensure_future(self._worker()) for _ in range(self.CONCURRENCY)]
+        self._pending.add(key)
+        self._queue.put_nowait((id, bitrate, gain))
+
+    def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        self.files.close()
+
+    def _has(self, key:str, gain:float):
+        entry = self.files.entries.get(key)
+        return entry is not None and abs(entry.get('gain', 1.0) - gain) <= self.GAIN_TOLERANCE
+
+    async def _worker(self):
+        while True:
+            id, bitrate, gain = await self._queue.get()
+            try:
+                await self._transcode(id, bitrate, gain)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f'ERROR: {type(e).__name__} - {e}')
+            finally:
+                self._pending.discard(SongLibrary.key(id, bitrate))
+
+    async def _transcode(self, id:int, bitrate:int, gain:float):
+        source = self.library.get(id, bitrate)
+        if source is None:
+            return
+        tempPath = self.files.temp_path(id, bitrate, 'ogg')
+        process = await asyncio.create_subprocess_exec(
+            'ffmpeg', '-nostats', '-loglevel', 'error', '-y',
+            '-i', source,
+            '-vn', '-map_metadata', '-1',
+            *(['-af', 'volume={:.4f}'.format(gain)] if gain != 1.0 else []),
+            '-c:a', 'libopus', '-b:a', '{}k'.format(self.bitrate),
+            '-ar', '48000', '-ac', '2', '-frame_duration', '20',
+            '-f', 'ogg', tempPath,
+            stdout = asyncio.subprocess.DEVNULL,
+            stderr = asyncio.subprocess.PIPE
+        )
+        _, stderr = await process.communicate()
+        if process.returncode != 0:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+            raise RuntimeError('Transcoding {} failed: {}'.format(source, stderr.decode(errors='replace').strip()))
+
+        path = self.files.add(id, bitrate, 'ogg', tempPath, meta={'gain' : round(gain, 4)})
+        print('Transcoded {} to {}'.format(source, path))
@@ -0,0 +1,126 @@
+import asyncio
+import musicSource
+from songQueue import SongQueue
+from discord.ext import commands
+from neteaseMusic import AsyncNeteaseMusic
+from qualityPolicy import QualityPolicy
+
+
+class PlaylistImporter():
+    '''
+    Stream the tracks of a playlist into a song queue.
+
+    Song details and availability are fetched in chunks with batched requests,
+    several chunks are resolved at once, and every track is put into the queue
+    as soon as it and the tracks before it are resolved, so playback starts
+    with the first song. A failing track is skipped without stopping the rest
+    of the import.
+    '''
+
+    CHUNK_SIZE = 100        # song ids resolved together
+    CONCURRENCY = 4         # chunks resolved at the same time
+
+    def __init__(self, ctx:commands.Context, ncm:AsyncNeteaseMusic, songs:SongQueue, br=320000, progress=None):
+        '''
+        :Args:
+            - ncm `AsyncNeteaseMusic`: shared api client
+            - songs `SongQueue`: queue receiving the tracks
+            - br `int`: bitrate the tracks should reach, lowered per track to what it is available at
+            - progress `coroutine function`: awaited as `progress(importer, music)` after each track
+        '''
+        self.ctx = ctx
+        self.ncm = ncm
+        self.songs = songs
+        self.br = br
+        self.vip = ncm.config.getboolean('config', 'vip', fallback=False)
+        self.progress = progress
+        self.chunkSize = ncm.config.getint('config', 'import_chunk_size', fallback=self.CHUNK_SIZE)
+        self.concurrency = ncm.config.getint('config', 'import_concurrency', fallback=self.CONCURRENCY)
+
+        self.total = 0
+        self.added = 0
+        self.skipped = []       # (song id, reason) of every track that was not queued
+        self._semaphore = None
+
+    @property
+    def done(self):
+        return self.added + len(self.skipped)
+
+    async def run(self, ids:list):
+        '''
+        Import the given song ids in order
+
+        :Args:
+            - ids `list`: song ids of the playlist
+        :Returns:
+            - skipped `list`: (song id, reason) of the tracks that could not be added
+        '''
+        self.total = len(ids)
+        if not ids:
+            return self.skipped
+        chunkCount = len(list(self._chunks(ids)))
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        # bounded so metadata is only fetched a few chunks ahead of the queue
+        pending = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        producer = asyncio.ensure_future(self._produce(ids, pending))
+        try:
+            for _ in range(chunkCount):
+                task = await pending.get()
+                for music in await task:
+                    if music is not None:
+                        await self.songs.put(music)
+                        self.added += 1
+                    if self.progress is not None:
+                        await self.progress(self, music)
+            await producer
+        finally:
+            producer.cancel()
+
+        return self.skipped
+
+    def _chunks(self, ids:list):
+        # a single leading track gets the first song playing right away
+        yield ids[:1]
+        for i in range(1, len(ids), self.chunkSize):
+            yield ids[i:i + self.chunkSize]
+
+    async def _produce(self, ids:list, pending:asyncio.Queue):
+        tasks = []
+        try:
+            for chunk in self._chunks(ids):
+                await self._semaphore.acquire()
+                task = asyncio.ensure_future(self._resolve_chunk(chunk))
+                task.add_done_callback(lambda _: self._semaphore.release())
+                tasks.append(task)
+                await pending.put(task)
+        except asyncio.CancelledError:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    async def _resolve_chunk(self, chunk:list):
+        '''
+        Resolve a chunk of song ids into queue entries, `None` for every skipped track
+        '''
+        try:
+            songs = {song['id']: song for song in await self.ncm.get_song(chunk) or []}
+            playable = await self.ncm.resolve_songs(list(songs.values()))
+        except Exception as e:
+            print(f'ERROR: {type(e).__name__} - {e}')
+            self.skipped.extend((songId, str(e)) for songId in chunk)
+            return [None] * len(chunk)
+
+        results = []
+        for songId in chunk:
+            info = songs.get(songId)
+            if info is None:
+                self.skipped.append((songId, 'song detail unavailable'))
+                results.append(None)
+            elif playable.get(songId) is None:
+                self.skipped.append((songId, 'no copyright: {}'.format(info.get('title'))))
+                results.append(None)
+            else:
+                br = QualityPolicy.choose(info, self.br, vip=self.vip)
+                results.append(musicSource.Music(self.ctx, info, playable[songId], br=br, download=False))
+        return results
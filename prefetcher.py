@@ -0,0 +1,135 @@
+import asyncio
+import musicSource
+from songQueue import SongQueue
+from neteaseMusic import AsyncNeteaseMusic
+
+
+class TrackPrefetcher():
+    '''
+    Open the audio of the next queued tracks shortly before the current one ends,
+    so a song change does not wait for url resolution and ffmpeg start-up.
+
+    Prefetched sources are tied to the queue entries they were opened for and
+    are released as soon as those entries leave the head of the queue.
+    '''
+
+    DEPTH = 1           # queued tracks opened ahead of time
+    LEAD = 15           # seconds before the end of the current track
+    PRIME_FRAMES = 50   # 20ms frames read ahead of playback
+
+    # called with the queue entry whenever a prefetched source is ready
+    on_ready = None
+
+    def __init__(self, loop:asyncio.AbstractEventLoop, ncm:AsyncNeteaseMusic, songs:SongQueue):
+        self.loop = loop
+        self.ncm = ncm
+        self.songs = songs
+        self.depth = ncm.config.getint('config', 'prefetch_depth', fallback=self.DEPTH)
+        self.lead = ncm.config.getfloat('config', 'prefetch_lead', fallback=self.LEAD)
+
+        self._timer = None
+        self._tasks = {}    # Music -> task opening its source
+
+    def schedule(self, current:musicSource.Music, volume:float):
+        '''
+        Plan the prefetch of the upcoming tracks for the track that just started,
+        or was reopened at another position (restored, seeked)
+        '''
+        self.cancel()
+        if self.depth <= 0:
+            return
+        duration = current.track.duration / 1000
+        position = current.source.position if current.source is not None else 0
+        delay = max(0, duration - position - self.lead)
+        self._timer = self.loop.create_task(self._run(delay, volume))
+
+    def cancel(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    async def _run(self, delay:float, volume:float):
+        await asyncio.sleep(delay)
+        self.discard_stale()
+        for music in self.songs[:self.depth]:
+            if music not in self._tasks:
+                self._tasks[music] = self.loop.create_task(self._open(music, volume))
+
+    async def _open(self, music:musicSource.Music, volume:float):
+        source = await music.open_source(self.ncm, volume)
+        try:
+            await self.loop.run_in_executor(None, source.prime, self.PRIME_FRAMES)
+        except BaseException:
+            source.cleanup()
+            raise
+        if self.on_ready is not None:
+            self.loop.call_soon(self.on_ready, music)
+        return source
+
+    async def take(self, music:musicSource.Music):
+        '''
+        Hand over the prefetched source of a track that is about to play
+
+        :Returns:
+            - source `TrackSource`: the opened source, or `None` if it was not prefetched
+        '''
+        task = self._tasks.pop(music, None)
+        if task is None:
+            return None
+        try:
+            return await task
+        except asyncio.CancelledError:
+            return None
+        except Exception as e:
+            print(f'ERROR: {type(e).__name__} - {e}')
+            return None
+
+    def take_ready(self, music:musicSource.Music):
+        '''
+        Like `take`, but only hands over a source that has already been opened
+
+        :Returns:
+            - source `TrackSource`: the opened source, or `None` if it is not ready
+        '''
+        task = self._tasks.get(music)
+        if task is None or not task.done() or task.cancelled() or task.exception() is not None:
+            return None
+        return self._tasks.pop(music).result()
+
+    def adopt(self, music:musicSource.Music, source:musicSource.TrackSource):
+        '''
+        Take back an opened source that was handed over but never played
+        '''
+        future = self.loop.create_future()
+        future.set_result(source)
+        old = self._tasks.pop(music, None)
+        if old is not None:
+            self._release(old)
+        self._tasks[music] = future
+        self.discard_stale()
+
+    def discard_stale(self, keep:bool=True):
+        '''
+        Release the prefetched sources of tracks no longer at the head of the queue
+
+        :Args:
+            - keep `bool`: `False` releases every source, e.g. while the current track
+                loops and the ones at the head of the queue would stay open indefinitely
+        '''
+        upcoming = set(self.songs[:self.depth]) if keep else set()
+        for music in list(self._tasks):
+            if music not in upcoming:
+                self._release(self._tasks.pop(music))
+
+    def clear(self):
+        self.cancel()
+        for task in self._tasks.values():
+            self._release(task)
+        self._tasks.clear()
+
+    @staticmethod
+    def _release(task:asyncio.Future):
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled() and task.exception() is None:
+            task.result().cleanup()
@@ -0,0 +1,61 @@
+class QualityPolicy():
+    '''
+    Pick the upstream bitrate of a track from the bitrate of the voice channel
+    it is played in.
+
+    Discord re-encodes every track to Opus at the channel's bitrate, 64-96 kbps
+    unless the server is boosted, so fetching more than the lowest tier that
+    covers it only costs bandwidth and decoding time.
+    '''
+
+    LADDER = (128000, 192000, 320000, 999000)   # bitrates served by the ncmApi, 999000 is lossless
+    FREE_BITRATE = 128000       # highest bitrate of songs that are free at low bitrate only
+    CHANNEL_BITRATE = 64000     # bitrate of a voice channel nobody has configured
+
+    @classmethod
+    def target(cls, channelBitrate:int=None):
+        '''
+        :Returns:
+            - bitrate `int`: the lowest tier of the ladder reaching the channel's bitrate
+        '''
+        channelBitrate = channelBitrate or cls.CHANNEL_BITRATE
+        for bitrate in cls.LADDER:
+            if bitrate >= channelBitrate:
+                return bitrate
+        return cls.LADDER[-1]
+
+    @classmethod
+    def available(cls, info:dict, vip:bool=False):
+        '''
+        :Returns:
+            - bitrates `list`: tiers of the ladder the song can be fetched at, lowest first
+        '''
+        highest = info.get('maxBitrate') or cls.LADDER[-1]
+        if not vip and info.get('fee') == 'low bitrate free':
+            highest = min(highest, cls.FREE_BITRATE)
+        bitrates = [bitrate for bitrate in cls.LADDER if bitrate <= highest]
+        return bitrates or [cls.LADDER[0]]
+
+    @classmethod
+    def ladder(cls, info:dict, target:int, vip:bool=False):
+        '''
+        Bitrates to try in order: the lowest available tier reaching `target`,
+        then the tiers below it from the highest down, then the ones above it
+
+        :Args:
+            - info `dict`: song metadata of `get_song`, for its `maxBitrate` and `fee`
+            - target `int`: bitrate the track should reach
+        :Returns:
+            - bitrates `list`: the fallback ladder, never empty
+        '''
+        bitrates = cls.available(info, vip)
+        above = [bitrate for bitrate in bitrates if bitrate >= target]
+        below = [bitrate for bitrate in bitrates if bitrate < target]
+        if not above:
+            # the song does not reach the target, its best tier comes first
+            above, below = [below[-1]], below[:-1]
+        return above[:1] + below[::-1] + above[1:]
+
+    @classmethod
+    def choose(cls, info:dict, target:int, vip:bool=False):
+        return cls.ladder(info, target, vip)[0]
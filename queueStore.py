@@ -0,0 +1,89 @@
+import os
+import json
+import time
+import asyncio
+import sqlite3
+
+
+class QueueStore():
+    '''
+    Snapshots of the guilds' playback kept on disk, so a restart of the bot or
+    a reload of the player cog resumes the queues instead of dropping them.
+
+    A snapshot only holds ids and numbers (see `VoiceState.snapshot`). Guilds
+    are marked when their state changes and written shortly after, so a burst
+    of changes such as a playlist import costs a single write.
+    '''
+
+    PATH = 'cache/queues.db'
+    DELAY = 2       # seconds a change waits for the ones following it
+
+    def __init__(self, path:str=None, delay:float=None):
+        self.path = path or self.PATH
+        self.delay = self.DELAY if delay is None else delay
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS queues ('
+            'guild INTEGER PRIMARY KEY, '
+            'data TEXT NOT NULL, '
+            'updated REAL NOT NULL)'
+        )
+        self._dirty = {}    # guild id -> state whose snapshot is due
+        self._timer = None
+
+    def load(self):
+        '''
+        :Returns:
+            - snapshots `dict`: snapshot of every guild keyed by guild id
+        '''
+        snapshots = {}
+        for guild, data in self._db.execute('SELECT guild, data FROM queues'):
+            try:
+                snapshots[guild] = json.loads(data)
+            except ValueError as e:
+                print(f'ERROR: {type(e).__name__} - {e}')
+        return snapshots
+
+    def save(self, guild:int, snapshot:dict):
+        '''
+        Write the snapshot of a guild, `None` deletes it
+        '''
+        self._dirty.pop(guild, None)
+        if snapshot is None:
+            self._db.execute('DELETE FROM queues WHERE guild = ?', (guild,))
+        else:
+            self._db.execute(
+                'INSERT OR REPLACE INTO queues (guild, data, updated) VALUES (?, ?, ?)',
+                (guild, json.dumps(snapshot, separators=(',', ':')), time.time())
+            )
+
+    def mark(self, guild:int, state):
+        '''
+        Schedule the snapshot of a guild's voice state to be written
+        '''
+        self._dirty[guild] = state
+        if self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(self.delay, self.flush)
+
+    def flush(self):
+        '''
+        Write the snapshots of every marked guild now
+        '''
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for guild, state in list(self._dirty.items()):
+            try:
+                self.save(guild, state.snapshot())
+            except Exception as e:
+                print(f'ERROR: {type(e).__name__} - {e}')
+                self._dirty.pop(guild, None)
+
+    def close(self):
+        self.flush()
+        self._db.close()
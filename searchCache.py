@@ -0,0 +1,74 @@
+import re
+import unicodedata
+from cache import TTLCache
+
+
+class SearchCache():
+    '''
+    Cache of search results keyed by the normalized query.
+
+    Keywords that only differ in case, whitespace or full-width/half-width form
+    share an entry, and a cached page also answers requests for fewer results
+    at the same offset.
+    '''
+
+    MAX_SIZE = 1024
+    TTL = 3600
+    COUNT_SUFFIX = re.compile(r'\s*-\s*(\d+)\s*$')
+    MAX_COUNT = 50      # a larger `-N` suffix is part of the keywords, e.g. `Blink-182`
+
+    def __init__(self, maxsize=None, ttl=None):
+        self._cache = TTLCache(
+            maxsize = maxsize or self.MAX_SIZE,
+            ttl = self.TTL if ttl is None else ttl
+        )
+
+    @classmethod
+    def parse_query(cls, keyword:str):
+        '''
+        Split the `-N` result count off a search command, only a count in
+        `1..MAX_COUNT - 1` is taken as one
+
+        :Returns:
+            - keywords `str`: the keywords without the count
+            - count `int`: the requested number of results, `None` if not given
+        '''
+        match = cls.COUNT_SUFFIX.search(keyword)
+        if match and 0 < int(match.group(1)) < cls.MAX_COUNT and keyword[:match.start()].strip():
+            return keyword[:match.start()], int(match.group(1))
+        return keyword, None
+
+    @classmethod
+    def normalize(cls, keywords:str):
+        # NFKC folds full-width letters, digits and spaces to their half-width form
+        keywords = unicodedata.normalize('NFKC', keywords)
+        return ' '.join(keywords.casefold().split())
+
+    def get(self, keywords:str, limit:int, offset:int, _type:int):
+        '''
+        :Returns:
+            - musicMetadata `dict`: the cached search result cut to `limit`, `None` on a miss
+        '''
+        entry = self._cache.get((self.normalize(keywords), offset, _type), count=False)
+        if entry is not None:
+            cachedLimit, result = entry
+            # a short page means there were no more results to fetch
+            if limit <= cachedLimit or len(result['info']) < cachedLimit:
+                self._cache.hits += 1
+                info = result['info'][:limit]
+                return {
+                    'query' : dict(result['query'], numDisplayed = len(info)),
+                    'info' : info
+                }
+        self._cache.misses += 1
+        return None
+
+    def set(self, keywords:str, limit:int, offset:int, _type:int, result:dict):
+        key = (self.normalize(keywords), offset, _type)
+        entry = self._cache.get(key, count=False)
+        # keep the larger page so it can keep answering smaller requests
+        if entry is None or limit >= entry[0]:
+            self._cache.set(key, (limit, result))
+
+    def stats(self):
+        return self._cache.stats()
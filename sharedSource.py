@@ -0,0 +1,236 @@
+import re
+import audioop
+import threading
+import discord
+from frameBuffer import FrameRing
+
+# how ffmpeg reports an expired or missing signed url
+HTTP_ERROR = re.compile(rb'Server returned (403|404)')
+FRAME_LENGTH = 0.02     # seconds of audio in a frame
+
+
+class SharedStream():
+    '''
+    One ffmpeg decode of a track whose frames are read by every subscribed player.
+
+    The decode runs at most `ahead` frames in front of the fastest reader and
+    never overwrites a frame the slowest reader still needs. A reader falling so
+    far behind that it stalls the others is dropped and marked `lost`.
+    '''
+
+    def __init__(self, broker, key:tuple, start:float, source:discord.AudioSource, capacity:int, ahead:int):
+        self.broker = broker
+        self.key = key
+        self.start = start
+        self.source = source
+        self.ahead = ahead
+        self.ring = FrameRing(capacity, SharedSourceBroker.OPUS_FRAME_SIZE if source.is_opus() else discord.opus.Encoder.FRAME_SIZE)
+        self.readers = set()
+        self.finished = False
+        self.closed = False
+        self.httpError = None
+        self._cond = threading.Condition()
+
+        threading.Thread(target=self._pump, daemon=True).start()
+        process = getattr(source, '_process', None)
+        if process is not None and process.stderr is not None:
+            threading.Thread(target=self._watch_stderr, args=(process.stderr,), daemon=True).start()
+
+    def index_of(self, start:float):
+        return round((start - self.start) / FRAME_LENGTH)
+
+    @property
+    def dead(self):
+        # the signed url was rejected, a retry has to start a decode of a fresh url
+        return self.httpError is not None
+
+    def can_attach(self, start:float):
+        index = self.index_of(start)
+        with self._cond:
+            if self.closed or index < self.ring.oldest or index > self.ring.written + self.ahead:
+                return False
+            # past the last frame of an ended decode there is nothing left to read
+            return index < self.ring.written or not (self.finished or self.dead)
+
+    def attach(self, reader):
+        with self._cond:
+            if self.closed:
+                reader.lost = True
+                return
+            self.readers.add(reader)
+            self._cond.notify_all()
+
+    def detach(self, reader):
+        with self._cond:
+            self.readers.discard(reader)
+            self._cond.notify_all()
+            if self.readers:
+                return
+            self.closed = True
+        self.broker.remove(self)
+        self.source.cleanup()
+
+    def read(self, reader):
+        with self._cond:
+            waited = False
+            # a dropped reader is lost, a detached one stopped reading, e.g. its read-ahead thread
+            while reader in self.readers:
+                data = self.ring.get(reader.cursor)
+                if data is not None:
+                    reader.cursor += 1
+                    self._cond.notify_all()
+                    return data
+                if self.finished or self.closed:
+                    break
+                # this reader waits on the decode, which waits on a reader far behind
+                if self._full():
+                    self._drop_slowest()
+                if not waited:
+                    reader.underruns += 1
+                    waited = True
+                self._cond.wait(0.1)
+        return b''
+
+    def _full(self):
+        cursors = [reader.cursor for reader in self.readers] or [self.ring.written]
+        return self.ring.written - min(cursors) >= self.ring.capacity or \
+            self.ring.written - max(cursors) >= self.ahead
+
+    def _drop_slowest(self):
+        slowest = min(self.readers, key=lambda reader: reader.cursor)
+        if self.ring.written - slowest.cursor >= self.ring.capacity:
+            slowest.lost = True
+            self.readers.discard(slowest)
+
+    def _pump(self):
+        while True:
+            with self._cond:
+                while not self.closed and self._full():
+                    self._cond.wait(0.5)
+                if self.closed:
+                    return
+            data = self.source.read()
+            with self._cond:
+                if not data:
+                    self.finished = True
+                    self._cond.notify_all()
+                    return
+                self.ring.append(data)
+                self._cond.notify_all()
+
+    def _watch_stderr(self, stderr):
+        for line in stderr:
+            match = HTTP_ERROR.search(line)
+            if match:
+                self.httpError = int(match.group(1))
+
+
+class SharedReader(discord.AudioSource):
+    '''
+    One player's view of a `SharedStream`, starting at its own offset
+    '''
+
+    def __init__(self, stream:SharedStream, start:float, volume:float=1.0):
+        self.stream = stream
+        self.cursor = stream.index_of(start)
+        self.volume = volume    # applied to PCM frames only, Opus streams are shared per volume
+        self.lost = False
+        self.underruns = 0      # reads that had to wait on the decode
+        stream.attach(self)
+
+    def read(self):
+        return self.scale(self.stream.read(self))
+
+    def scale(self, data:bytes):
+        # applies the subscriber's volume to a PCM frame of the stream
+        if data and self.volume != 1.0 and not self.stream.source.is_opus():
+            data = audioop.mul(data, 2, min(self.volume, 2.0))
+        return data
+
+    def is_opus(self):
+        return self.stream.source.is_opus()
+
+    def cleanup(self):
+        self.stream.detach(self)
+
+
+class SharedSourceBroker():
+    '''
+    Decode each track once for every guild playing it.
+
+    Streams are keyed by song, bitrate and output format. A subscriber joins a
+    running stream when its start offset is still inside the stream's buffer,
+    otherwise a new decode is started at that offset.
+    '''
+
+    SECONDS = 30            # history kept for late joiners
+    AHEAD = 5               # seconds a decode may run in front of its fastest reader
+    OPUS_FRAME_SIZE = 1500  # bytes per slot, above the largest 20ms Opus packet
+
+    def __init__(self, seconds:float=None, ahead:float=None):
+        self.capacity = int((seconds or self.SECONDS) / FRAME_LENGTH)
+        self.ahead = int((ahead or self.AHEAD) / FRAME_LENGTH)
+        self._streams = {}      # key -> running streams of that track
+        self._lock = threading.Lock()
+
+    def subscribe(self, key:tuple, start:float, open, volume:float=1.0, reader=SharedReader):
+        '''
+        :Args:
+            - key `tuple`: identifies the decoded audio, e.g. (song id, bitrate, format)
+            - start `float`: position in seconds the subscriber starts at
+            - open `callable`: `open(start)` returns a new ffmpeg source when no stream covers `start`
+            - volume `float`: volume of the subscriber for PCM streams
+            - reader `callable`: `reader(stream, start, volume)` builds the subscriber
+        :Returns:
+            - reader `SharedReader`: the subscriber's audio source
+        '''
+        with self._lock:
+            stream = self._find(key, start)
+            if stream is not None:
+                return reader(stream, start, volume)
+        # spawning ffmpeg is slow, other subscribers do not wait on it
+        source = open(start)
+        with self._lock:
+            # another subscriber may have started a decode covering `start` meanwhile
+            stream = self._find(key, start)
+            if stream is None:
+                stream = SharedStream(self, key, start, source, self.capacity, self.ahead)
+                self._streams.setdefault(key, []).append(stream)
+                source = None
+            subscriber = reader(stream, start, volume)
+        if source is not None:
+            source.cleanup()
+        return subscriber
+
+    def _find(self, key:tuple, start:float):
+        # called with the lock held, dead streams are forgotten so they are never joined again
+        streams = self._streams.get(key)
+        if not streams:
+            return None
+        streams[:] = [stream for stream in streams if not stream.dead]
+        if not streams:
+            del self._streams[key]
+            return None
+        for stream in streams:
+            if stream.can_attach(start):
+                return stream
+        return None
+
+    def remove(self, stream:SharedStream):
+        with self._lock:
+            streams = self._streams.get(stream.key, [])
+            if stream in streams:
+                streams.remove(stream)
+            if not streams:
+                self._streams.pop(stream.key, None)
+
+    def stats(self):
+        with self._lock:
+            streams = [stream for streams in self._streams.values() for stream in streams]
+        return {
+            'streams' : len(streams),
+            'readers' : sum(len(stream.readers) for stream in streams)
+        }
+
+
+broker = SharedSourceBroker()
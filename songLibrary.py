@@ -0,0 +1,177 @@
+import os
+import json
+import time
+from collections import OrderedDict
+
+
+class SongLibrary():
+    '''
+    Downloaded songs kept on disk by song id and bitrate.
+
+    An index file records every entry in least recently used order, so a lookup
+    is a dictionary hit and never lists or stats the directory. Files are
+    written under a temporary name and renamed into place, and the least
+    recently played songs are deleted once the library exceeds its byte budget.
+    '''
+
+    PATH = 'songs/'
+    INDEX = 'index.json'
+    MAX_BYTES = 2 * 1024 ** 3   # 2 GiB
+    SAVE_INTERVAL = 60          # seconds between index writes caused by lookups alone
+    STALE_PART = 24 * 3600      # seconds after which a partial download left by a crash is deleted
+
+    def __init__(self, path:str=None, maxBytes:int=None):
+        self.path = path or self.PATH
+        self.maxBytes = self.MAX_BYTES if maxBytes is None else maxBytes
+        os.makedirs(self.path, exist_ok=True)
+
+        self.entries = OrderedDict()    # key -> {'file', 'size', 'type', 'accessed'}, oldest first
+        self.size = 0
+        self._saved = time.monotonic()
+        self._dirty = False
+        self._load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    @staticmethod
+    def key(id:int, bitrate:int):
+        return '{}:{}'.format(int(id), int(bitrate))
+
+    def get(self, id:int, bitrate:int):
+        '''
+        Find a song in the library and mark it as recently used
+
+        :Returns:
+            - path `str`: path of the audio file, `None` if the song is not in the library
+        '''
+        key = self.key(id, bitrate)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        entry['accessed'] = time.time()
+        self.entries.move_to_end(key)
+        self._dirty = True
+        if time.monotonic() - self._saved > self.SAVE_INTERVAL:
+            self.save()
+        return os.path.join(self.path, entry['file'])
+
+    def temp_path(self, id:int, bitrate:int, ext:str):
+        '''
+        Path to write a download to before it is added with `add`
+        '''
+        return os.path.join(self.path, '{}.part'.format(self._filename(id, bitrate, ext)))
+
+    def discard(self, tempPath:str):
+        '''
+        Delete a download from `temp_path` that will not be resumed
+        '''
+        self._unlink(os.path.basename(tempPath))
+
+    def add(self, id:int, bitrate:int, ext:str, tempPath:str, meta:dict=None):
+        '''
+        Move a finished download into the library
+
+        :Args:
+            - tempPath `str`: the completed file, usually from `temp_path`
+            - meta `dict`: extra fields kept in the index entry of the file
+        :Returns:
+            - path `str`: final path of the audio file
+        '''
+        key = self.key(id, bitrate)
+        filename = self._filename(id, bitrate, ext)
+        path = os.path.join(self.path, filename)
+        # the rename is atomic, readers never see a half written file
+        os.replace(tempPath, path)
+
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old['size']
+            if old['file'] != filename:
+                self._unlink(old['file'])
+
+        size = os.path.getsize(path)
+        self.entries[key] = dict(meta or {}, file=filename, size=size, type=ext, accessed=time.time())
+        self.size += size
+        self.evict(keep=key)
+        self.save()
+        return path
+
+    def remove(self, id:int, bitrate:int):
+        entry = self.entries.pop(self.key(id, bitrate), None)
+        if entry is not None:
+            self.size -= entry['size']
+            self._unlink(entry['file'])
+            self.save()
+
+    def evict(self, keep:str=None):
+        '''
+        Delete the least recently used songs until the library fits its byte budget
+        '''
+        for key in list(self.entries):
+            if self.size <= self.maxBytes:
+                break
+            if key == keep:
+                continue
+            entry = self.entries.pop(key)
+            self.size -= entry['size']
+            self._unlink(entry['file'])
+            print('Evicted {} from the song library'.format(entry['file']))
+
+    def save(self):
+        '''
+        Write the index atomically
+        '''
+        path = os.path.join(self.path, self.INDEX)
+        temp = path + '.tmp'
+        with open(temp, 'w', encoding='UTF-8') as f:
+            json.dump([dict(entry, key=key) for key, entry in self.entries.items()], f)
+        os.replace(temp, path)
+        self._saved = time.monotonic()
+        self._dirty = False
+
+    def close(self):
+        if self._dirty:
+            self.save()
+
+    def _load(self):
+        self._sweep()
+        path = os.path.join(self.path, self.INDEX)
+        try:
+            with open(path, encoding='UTF-8') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            print(f'ERROR: {type(e).__name__} - {e}')
+            return
+
+        for entry in sorted(entries, key=lambda entry: entry['accessed']):
+            key = entry.pop('key')
+            # files deleted by hand are dropped from the index
+            if os.path.exists(os.path.join(self.path, entry['file'])):
+                self.entries[key] = entry
+                self.size += entry['size']
+
+    def _sweep(self):
+        # partial downloads are not in the index, old ones were left by a crash and count against no budget
+        now = time.time()
+        for entry in os.scandir(self.path):
+            try:
+                if entry.name.endswith('.part') and now - entry.stat().st_mtime > self.STALE_PART:
+                    os.remove(entry.path)
+            except OSError as e:
+                print(f'ERROR: {type(e).__name__} - {e}')
+
+    def _unlink(self, filename:str):
+        try:
+            os.remove(os.path.join(self.path, filename))
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _filename(id:int, bitrate:int, ext:str):
+        return '{}_{}.{}'.format(int(id), int(bitrate), ext)
@@ -1,14 +1,368 @@
 import asyncio
-import itertools
 import random
+from bisect import bisect_right
+from collections import deque
+from itertools import chain, islice
+
+
+class BlockList():
+    '''
+    A list stored as a sequence of short blocks.
+
+    Positional access, insertion and removal copy at most one block of entries,
+    and locating a position bisects an index of block offsets that is rebuilt
+    after a change: O(n / BLOCK_SIZE) integer work, a handful of blocks for a
+    queue of thousands of tracks, instead of the O(n) entry walk of a deque. A
+    slice starts at its block instead of walking from the head. Blocks shrunk
+    by removals are merged into a neighbour, so churn does not fragment the list.
+    '''
+
+    BLOCK_SIZE = 256    # a block is split once it holds twice as many entries
+    MIN_BLOCK = 64      # a smaller block is merged into its neighbour
+
+    def __init__(self, items=()):
+        items = list(items)
+        self._blocks = [items[i:i + self.BLOCK_SIZE] for i in range(0, len(items), self.BLOCK_SIZE)]
+        self._len = len(items)
+        self._offsets = None    # index of the first entry of every block, rebuilt after a change
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return chain.from_iterable(self._blocks)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._slice(index)
+        block, i = self._locate(index)
+        return self._blocks[block][i]
+
+    def __setitem__(self, index:int, item):
+        block, i = self._locate(index)
+        self._blocks[block][i] = item
+
+    def __delitem__(self, index:int):
+        self.pop(index)
+
+    def append(self, item):
+        if not self._blocks or len(self._blocks[-1]) >= self.BLOCK_SIZE:
+            self._blocks.append([])
+            self._offsets = None
+        self._blocks[-1].append(item)
+        self._len += 1
+
+    def insert(self, index:int, item):
+        '''
+        :Returns:
+            - index `int`: position the item ended up at
+        '''
+        if index >= self._len or not self._blocks:
+            self.append(item)
+            return self._len - 1
+        if index < -self._len:
+            index = 0
+        elif index < 0:
+            index += self._len
+        block, i = self._locate(index)
+        entries = self._blocks[block]
+        entries.insert(i, item)
+        if len(entries) > 2 * self.BLOCK_SIZE:
+            self._blocks[block:block + 1] = [entries[:self.BLOCK_SIZE], entries[self.BLOCK_SIZE:]]
+        self._len += 1
+        self._offsets = None
+        return index
+
+    def pop(self, index:int=-1):
+        block, i = self._locate(index)
+        entries = self._blocks[block]
+        item = entries.pop(i)
+        if not entries:
+            del self._blocks[block]
+        elif len(entries) < self.MIN_BLOCK and len(self._blocks) > 1:
+            self._merge(block)
+        self._len -= 1
+        self._offsets = None
+        return item
+
+    def _merge(self, block:int):
+        # join the block with the following one (the previous one for the last block)
+        first = min(block, len(self._blocks) - 2)
+        entries = self._blocks[first] + self._blocks[first + 1]
+        if len(entries) > 2 * self.BLOCK_SIZE:
+            half = len(entries) // 2
+            self._blocks[first:first + 2] = [entries[:half], entries[half:]]
+        else:
+            self._blocks[first:first + 2] = [entries]
+
+    def popleft(self):
+        return self.pop(0)
+
+    def move(self, source:int, destination:int):
+        '''
+        Move the entry at `source` so it ends up at index `destination`
+
+        :Returns:
+            - index `int`: position the entry ended up at
+        '''
+        return self.insert(destination, self.pop(source))
+
+    def clear(self):
+        self._blocks = []
+        self._len = 0
+        self._offsets = None
+
+    def shuffle(self):
+        '''
+        Fisher-Yates shuffle swapping the entries in place; the block sizes
+        do not change, so the offset index stays valid throughout
+        '''
+        for last in range(self._len - 1, 0, -1):
+            a, i = self._locate(last)
+            b, j = self._locate(random.randint(0, last))
+            self._blocks[a][i], self._blocks[b][j] = self._blocks[b][j], self._blocks[a][i]
+
+    def _locate(self, index:int):
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError('BlockList index out of range')
+        if self._offsets is None:
+            self._offsets = []
+            offset = 0
+            for entries in self._blocks:
+                self._offsets.append(offset)
+                offset += len(entries)
+        block = bisect_right(self._offsets, index) - 1
+        return block, index - self._offsets[block]
+
+    def _slice(self, index:slice):
+        start, stop, step = index.indices(self._len)
+        if step != 1 or start >= stop:
+            return list(islice(self, start, stop, step)) if step > 0 else list(self)[index]
+        block, i = self._locate(start)
+        result = []
+        for entries in islice(self._blocks, block, None):
+            result.extend(entries[i:i + stop - start - len(result)])
+            i = 0
+            if len(result) >= stop - start:
+                break
+        return result
+
+
+class FairQueue():
+    '''
+    Entries kept in one sub-queue per requester, played round-robin so one
+    requester's playlist does not hold everyone else back.
+
+    A requester with weight `n` gets `n` tracks per turn. Taking the next entry
+    is O(1); the effective play order is produced lazily by `__iter__`, so
+    showing a page of it never builds the whole merged list. Positional access,
+    `insert` and `move` replay the turns up to the position, O(n) at worst.
+    '''
+
+    def __init__(self, key):
+        self.key = key          # key(entry) -> requester of the entry
+        self.weights = {}       # requester -> tracks per turn, 1 by default
+        self._queues = {}       # requester -> BlockList of their entries
+        self._ring = deque()    # requesters with queued entries, the one playing next first
+        self._credit = 0        # tracks left in the turn of the first requester
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return (entry for _, _, entry in self._order())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._len)
+            return list(islice(self, start, stop, step)) if step > 0 else list(self)[index]
+        return self._locate(index)[2]
+
+    def __delitem__(self, index:int):
+        self.pop(index)
+
+    def weight(self, requester):
+        return self.weights.get(requester, 1)
+
+    def set_weight(self, requester, weight:int):
+        self.weights[requester] = max(1, int(weight))
+
+    def append(self, entry):
+        requester = self.key(entry)
+        queue = self._queues.get(requester)
+        if queue is None:
+            queue = self._queues[requester] = BlockList()
+            self._ring.append(requester)
+            if len(self._ring) == 1:
+                self._credit = self.weight(requester)
+        queue.append(entry)
+        self._len += 1
+
+    def popleft(self):
+        if not self._len:
+            raise IndexError('pop from an empty FairQueue')
+        requester = self._ring[0]
+        entry = self._queues[requester].popleft()
+        self._len -= 1
+        self._credit -= 1
+        if not self._queues[requester]:
+            del self._queues[requester]
+            self._ring.popleft()
+            self._new_turn()
+        elif self._credit <= 0:
+            self._ring.rotate(-1)
+            self._new_turn()
+        return entry
+
+    def pop(self, index:int=-1):
+        # unlike `popleft`, removing an entry does not use up its requester's turn
+        requester, position, entry = self._locate(index)
+        queue = self._queues[requester]
+        del queue[position]
+        self._len -= 1
+        if not queue:
+            del self._queues[requester]
+            first = self._ring[0] == requester
+            self._ring.remove(requester)
+            if first:
+                self._new_turn()
+        return entry
+
+    def insert(self, index:int, entry):
+        '''
+        Insert an entry among the entries of its requester, before those of
+        them that play at or after `index`. The turns decide where it plays,
+        which is not necessarily at `index`.
+
+        :Returns:
+            - index `int`: position the entry ended up at in the play order
+        '''
+        requester = self.key(entry)
+        if requester not in self._queues:
+            self.append(entry)
+            position = 0
+        else:
+            position = sum(1 for other, _, _ in islice(self._order(), max(0, index)) if other == requester)
+            self._queues[requester].insert(position, entry)
+            self._len += 1
+        # the turns are replayed up to the entry only, not over the whole queue
+        return next(i for i, (other, at, _) in enumerate(self._order()) if other == requester and at == position)
+
+    def move(self, source:int, destination:int):
+        '''
+        Reorder an entry among the entries of its requester, the turns stay fair
+
+        :Returns:
+            - index `int`: position the entry ended up at in the play order
+        '''
+        return self.insert(destination, self.pop(source))
+
+    def clear(self):
+        self._queues.clear()
+        self._ring.clear()
+        self._credit = 0
+        self._len = 0
+
+    def shuffle(self):
+        for queue in self._queues.values():
+            queue.shuffle()
+
+    def _new_turn(self):
+        self._credit = self.weight(self._ring[0]) if self._ring else 0
+
+    def _order(self):
+        '''
+        Replay the round-robin without consuming anything
+
+        :Yields:
+            - requester, position in their sub-queue, entry
+        '''
+        ring = deque(self._ring)
+        entries = {requester: enumerate(self._queues[requester]) for requester in ring}
+        left = {requester: len(self._queues[requester]) for requester in ring}
+        credit = self._credit
+        while ring:
+            requester = ring[0]
+            position, entry = next(entries[requester])
+            yield requester, position, entry
+            left[requester] -= 1
+            credit -= 1
+            if not left[requester]:
+                ring.popleft()
+                credit = self.weight(ring[0]) if ring else 0
+            elif credit <= 0:
+                ring.rotate(-1)
+                credit = self.weight(ring[0])
+
+    def _locate(self, index:int):
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError('FairQueue index out of range')
+        return next(islice(self._order(), index, None))
 
 
 class SongQueue(asyncio.Queue):
+    '''
+    The track queue of a guild: `get()` waits for the next track like an
+    `asyncio.Queue`, while paging, moving and removing entries by position
+    stay cheap for queues of thousands of tracks. In fair mode the entries
+    are played in turns per requester, see `FairQueue`.
+
+    With a `maxsize`, `put()` waits for room, which holds a playlist import
+    back until the queue plays down.
+    '''
+
+    # called without arguments whenever entries are removed or reordered
+    on_change = None
+    # called without arguments after any change of the entries, `put` and `get` included
+    on_update = None
+
+    def _init(self, maxsize):
+        self._queue = BlockList()
+
+    @property
+    def fair(self):
+        return isinstance(self._queue, FairQueue)
+
+    def set_fair(self, fair: bool, key=None):
+        '''
+        Switch between first come first served and round-robin across requesters,
+        keeping the current play order of the entries
+
+        :Args:
+            - fair `bool`: play the requesters' tracks in turns
+            - key `callable`: `key(entry)` returns the requester of an entry
+        '''
+        if fair == self.fair:
+            return
+        entries = list(self._queue)
+        self._queue = FairQueue(key) if fair else BlockList()
+        for entry in entries:
+            self._queue.append(entry)
+        self._changed()
+
+    def set_weight(self, requester, weight: int):
+        '''
+        Tracks `requester` plays per turn in fair mode
+        '''
+        self._queue.set_weight(requester, weight)
+        self._changed()
+
+    def _put(self, item):
+        self._queue.append(item)
+        self._updated()
+
+    def _get(self):
+        item = self._queue.popleft()
+        self._updated()
+        return item
+
     def __getitem__(self, item):
-        if isinstance(item, slice):
-            return list(itertools.islice(self._queue, item.start, item.stop, item.step))
-        else:
-            return self._queue[item]
+        return self._queue[item]
 
     def __iter__(self):
         return self._queue.__iter__()
@@ -16,15 +370,60 @@ class SongQueue(asyncio.Queue):
     def __len__(self):
         return self.qsize()
 
+    def insert(self, index: int, item):
+        '''
+        Queue an entry at a position instead of the end, e.g. to play it next.
+        In fair mode the requester's turns decide the position.
+
+        :Returns:
+            - index `int`: position the entry ended up at
+        '''
+        if self.full():
+            raise asyncio.QueueFull
+        index = self._queue.insert(index, item)
+        self._unfinished_tasks += 1
+        self._finished.clear()
+        self._wakeup_next(self._getters)
+        self._changed()
+        return index
+
+    def move(self, source: int, destination: int):
+        '''
+        :Returns:
+            - index `int`: position the entry ended up at, in fair mode not necessarily `destination`
+        '''
+        index = self._queue.move(source, destination)
+        self._changed()
+        return index
+
     def clear(self):
         self._queue.clear()
+        self._freed()
+        self._changed()
 
     def shuffle(self):
-        random.shuffle(self._queue)
+        self._queue.shuffle()
+        self._changed()
 
     def remove(self, index: int):
         del self._queue[index]
-    
+        self._freed()
+        self._changed()
+
+    def _freed(self):
+        # entries removed without `get()` make room for waiting producers too
+        while self._putters and not self.full():
+            self._wakeup_next(self._putters)
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
+        self._updated()
+
+    def _updated(self):
+        if self.on_update is not None:
+            self.on_update()
+
     def size(self):
         return self.__len__()
 
@@ -37,4 +436,4 @@ async def main():
     print(songs.size())
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
@@ -0,0 +1,122 @@
+import audioop
+import threading
+import discord
+
+FRAME_LENGTH = 0.02     # seconds of audio in a frame
+
+
+class TrackMixer(discord.AudioSource):
+    '''
+    The source handed to the voice client for a run of consecutive tracks.
+
+    It plays the current track and, once it ends, carries on with the upcoming
+    track opened ahead of time within the same read, so there is no gap and the
+    voice player thread keeps running between songs. Two PCM tracks can be
+    crossfaded over the last seconds of the current one.
+    '''
+
+    def __init__(self, source:discord.AudioSource, crossfade:float=0, on_switch=None):
+        self.current = source
+        self.upcoming = None    # (music, source) played once the current source ends
+        self.fadeFrames = int(crossfade / FRAME_LENGTH)
+        # on_switch(old, music) is called from the player thread when the upcoming track takes over
+        self.on_switch = on_switch
+        self._fade = 0          # frames mixed so far of a running crossfade
+        self._lock = threading.Lock()
+
+    def queue(self, music, source:discord.AudioSource):
+        with self._lock:
+            old, self.upcoming = self.upcoming, (music, source)
+        if old is not None:
+            old[1].cleanup()
+
+    def unqueue(self):
+        '''
+        :Returns:
+            - upcoming `tuple`: the (music, source) that was queued, `None` if there was none
+        '''
+        with self._lock:
+            upcoming, self.upcoming = self.upcoming, None
+            self._fade = 0
+        return upcoming
+
+    def replace(self, old:discord.AudioSource, new:discord.AudioSource):
+        '''
+        Swap the current source, e.g. reopened at another position
+
+        :Returns:
+            - replaced `bool`: `False` if `old` is no longer playing
+        '''
+        with self._lock:
+            if self.current is not old:
+                return False
+            self.current = new
+            return True
+
+    def read(self):
+        # the lock only guards the references: a read may block on a stalled stream
+        # and must not hold up `queue`, `unqueue` or `replace` on the event loop
+        with self._lock:
+            current, upcoming = self.current, self.upcoming
+        data = current.read()
+        if upcoming is None:
+            return data
+        if not data:
+            # a broken stream is resumed by the voice state instead
+            if getattr(current, 'failed', False):
+                return data
+            if self._switch(current, upcoming):
+                return upcoming[1].read()
+            # replaced while it was read, carry on with the new source
+            return self.read() if self.current is not current else data
+        if self._fading(current, upcoming):
+            data = self._mix(data, current, upcoming)
+        return data
+
+    def _fading(self, current:discord.AudioSource, upcoming:tuple):
+        if self._fade:
+            return True
+        if not self.fadeFrames or current.is_opus() or upcoming[1].is_opus():
+            return False
+        duration = current.music.track.duration / 1000
+        return duration > 0 and current.position >= duration - self.fadeFrames * FRAME_LENGTH
+
+    def _mix(self, data:bytes, current:discord.AudioSource, upcoming:tuple):
+        incoming = upcoming[1].read()
+        if len(incoming) != len(data):
+            return data
+        with self._lock:
+            if self.current is not current or self.upcoming is not upcoming:
+                # unqueued or replaced during the reads
+                return data
+            self._fade += 1
+            gain = self._fade / self.fadeFrames
+            done = self._fade >= self.fadeFrames
+        data = audioop.add(audioop.mul(data, 2, 1 - gain), audioop.mul(incoming, 2, gain), 2)
+        if done:
+            self._switch(current, upcoming)
+        return data
+
+    def _switch(self, current:discord.AudioSource, upcoming:tuple):
+        '''
+        Let the upcoming track take over unless the sources changed meanwhile
+
+        :Returns:
+            - switched `bool`
+        '''
+        with self._lock:
+            if self.current is not current or self.upcoming is not upcoming:
+                return False
+            self.current = upcoming[1]
+            self.upcoming = None
+            self._fade = 0
+        if self.on_switch is not None:
+            self.on_switch(current, upcoming[0])
+        return True
+
+    def is_opus(self):
+        return self.current.is_opus()
+
+    def cleanup(self):
+        # the upcoming source is left to the voice state, it may still play
+        self.current.cleanup()
@@ -0,0 +1,140 @@
+import sys
+import weakref
+from collections.abc import Mapping
+
+
+class Artist():
+    '''
+    An artist shared by every track that credits it
+    '''
+    __slots__ = ('id', 'name', '__weakref__')
+
+    # id -> artist, kept while a queued track refers to it
+    _interned = weakref.WeakValueDictionary()
+
+    def __init__(self, id:int, name:str):
+        self.id = id
+        self.name = sys.intern(name or '')
+
+    @classmethod
+    def get(cls, id:int, name:str):
+        artist = cls._interned.get(id)
+        if artist is None or artist.name != name:
+            artist = cls._interned[id] = cls(id, name)
+        return artist
+
+
+class Album():
+    '''
+    An album shared by every track on it
+    '''
+    __slots__ = ('id', 'name', 'picture', 'publishTime', '__weakref__')
+
+    _interned = weakref.WeakValueDictionary()
+
+    def __init__(self, id:int, name:str, picture:str, publishTime:str):
+        self.id = id
+        self.name = sys.intern(name or '')
+        self.picture = picture
+        self.publishTime = publishTime
+
+    @classmethod
+    def get(cls, id:int, name:str, picture:str, publishTime:str):
+        album = cls._interned.get(id)
+        if album is None or album.name != name or album.picture != picture:
+            album = cls._interned[id] = cls(id, name, picture, publishTime)
+        return album
+
+
+class TrackRecord():
+    '''
+    The metadata of a queued track in a compact form: numeric duration and
+    sizes, interned artists and album, and display strings derived on demand.
+    `TrackView` shows it with the record layout of `get_song`.
+    '''
+    __slots__ = ('id', 'title', 'artists', 'album', 'duration', 'sizes', 'fee', 'maxBitrate', 'altSongId')
+
+    BITRATES = (128000, 192000, 320000)     # bitrates of `sizes`
+    FEES = ('free', 'Vip Only', 'low bitrate free')
+
+    def __init__(self, id:int, title:str, artists:tuple, album:Album, duration:int,
+                 sizes:tuple=(0, 0, 0), fee:str='free', maxBitrate:int=None, altSongId=None):
+        self.id = id
+        self.title = title
+        self.artists = artists      # tuple of `Artist`
+        self.album = album
+        self.duration = duration    # ms
+        self.sizes = sizes          # bytes per bitrate of `BITRATES`
+        # one of the shared `FEES` strings
+        self.fee = self.FEES[self.FEES.index(fee)] if fee in self.FEES else fee
+        self.maxBitrate = maxBitrate
+        self.altSongId = altSongId
+
+    @classmethod
+    def from_dict(cls, data:dict):
+        '''
+        Build a record from a song record of `get_song`
+        '''
+        sizes = data.get('bytes')
+        if sizes is None:
+            # records cached before byte sizes were kept only have the 'x.x MB' strings
+            sizes = {bitrate: float(size.split()[0]) * 1_000_000 for bitrate, size in data.get('size', {}).items()}
+        album = data['album']
+        return cls(
+            id = data['id'],
+            title = data['title'],
+            artists = tuple(Artist.get(artist['id'], artist['name']) for artist in data['artist']),
+            album = Album.get(album['id'], album['name'], album.get('picture'), album.get('publishTime')),
+            duration = data.get('duration', 0),
+            sizes = tuple(int(sizes.get(bitrate, 0)) for bitrate in cls.BITRATES),
+            fee = data.get('fee', 'free'),
+            maxBitrate = data.get('maxBitrate'),
+            altSongId = data.get('altSongId')
+        )
+
+    @property
+    def length(self):
+        return '%02d:%02d' % divmod(self.duration / 1000, 60)
+
+    @property
+    def filename(self):
+        # the filename contains all of the artist names
+        return '%s - %s' % (' & '.join(artist.name for artist in self.artists), self.title)
+
+    @property
+    def url(self):
+        return 'https://music.163.com/#/song?id=%s' % self.id
+
+    @property
+    def size(self):
+        return {bitrate: '{:.1f} MB'.format(size / 1_000_000) for bitrate, size in zip(self.BITRATES, self.sizes)}
+
+
+class TrackView(Mapping):
+    '''
+    Read-only view of a `TrackRecord` with the dict layout of `get_song`,
+    for code written against the song records
+    '''
+    __slots__ = ('record',)
+
+    KEYS = ('title', 'artist', 'album', 'length', 'duration', 'id', 'size', 'fee', 'maxBitrate', 'url', 'altSongId', 'filename')
+
+    def __init__(self, record:TrackRecord):
+        self.record = record
+
+    def __getitem__(self, key):
+        record = self.record
+        if key == 'artist':
+            return [dict(name=artist.name, id=artist.id) for artist in record.artists]
+        if key == 'album':
+            album = record.album
+            return dict(name=album.name, id=album.id, picture=album.picture, publishTime=album.publishTime)
+        if key in self.KEYS:
+            return getattr(record, key)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
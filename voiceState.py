@@ -1,28 +1,199 @@
+import sys
+import time
 import asyncio
+import discord
 import musicSource
+from neteaseMusic import AsyncNeteaseMusic
 from songQueue import SongQueue
+from prefetcher import TrackPrefetcher
+from trackMixer import TrackMixer
+from qualityPolicy import QualityPolicy
+from trackRecord import TrackRecord, Artist, Album
 from discord.ext import commands
 from async_timeout import timeout
 
 
 class VoiceState:
-    def __init__(self, bot: commands.Bot, ctx: commands.Context):
+    '''
+    Playback state of a guild: its queue, the playing track and the voice client.
+
+    Creating a state is cheap, the player task only starts with `start` once
+    something is played, and `close` releases everything an idle state holds.
+    '''
+
+    STREAM_RETRIES = 2  # times a track is resumed after its stream failed
+
+    def __init__(self, bot: commands.Bot, ctx: commands.Context, ncm: AsyncNeteaseMusic = None):
         self.bot = bot
         self._ctx = ctx
+        self.ncm = ncm or AsyncNeteaseMusic()
 
         self.current = None
         self.voice = None
         self.next = asyncio.Event()
-        self.songs = SongQueue()
+        # a bounded queue holds playlist imports back until it plays down
+        self.songs = SongQueue(maxsize=self.ncm.config.getint('config', 'queue_max_size', fallback=0))
+        if self.ncm.config.getboolean('config', 'fair_queue', fallback=False):
+            self.songs.set_fair(True, self.requester_of)
+        self.prefetcher = TrackPrefetcher(bot.loop, self.ncm, self.songs)
+        self.songs.on_change = self._queue_changed
+        self.songs.on_update = self._updated
+        self.prefetcher.on_ready = self._source_ready
+        self.mixer = None       # the source the voice client plays, spans gapless transitions
+        self._handedOver = None     # queue entry the mixer switched to
+        self.crossfade = self.ncm.config.getfloat('config', 'crossfade', fallback=0)
 
         self._loop = False
-        self._volume = 0.75
+        self._volume = self.ncm.config.getfloat('config', 'volume', fallback=0.75)
         self.skip_votes = set()
+        self.bitrate = None     # upstream bitrate chosen by `.quality`, `None` follows the voice channel
+        self.underruns = 0      # buffer underruns of the sources already released
+        self._error = None      # error the voice player thread stopped with
+        self.lastActive = time.monotonic()
+        self._resume = None     # (entry, position) a restored track continues from
+        self.on_update = None   # called without arguments whenever `snapshot` may have changed
 
-        self.audio_player = bot.loop.create_task(self.audio_player_task())
+        self.audio_player = None
 
     def __del__(self):
-        self.audio_player.cancel()
+        if self.audio_player is not None:
+            self.audio_player.cancel()
+
+    def start(self):
+        '''
+        Run the player task, again if it ended after waiting too long for a song
+        '''
+        if self.audio_player is None or self.audio_player.done():
+            self.audio_player = self.bot.loop.create_task(self.audio_player_task())
+
+    def touch(self):
+        self.lastActive = time.monotonic()
+
+    @property
+    def idle(self):
+        # nothing playing, queued or connected
+        return not self.voice and self.current is None and not len(self.songs)
+
+    @property
+    def customised(self):
+        # settings a member chose with `.quality`, `.fair` or `.weight`, lost if the state is released
+        fair = self.ncm.config.getboolean('config', 'fair_queue', fallback=False)
+        return bool(self.bitrate) or self.songs.fair != fair or bool(getattr(self.songs._queue, 'weights', None))
+
+    def memory(self):
+        '''
+        Estimate the memory held by the state
+
+        :Returns:
+            - memory `dict`: bytes of the queue entries with their metadata and of the read-ahead buffers
+        '''
+        entries = list(self.songs)
+        if self.current is not None:
+            entries.append(self.current)
+        # artists and albums are shared between entries, each is counted once
+        seen = set()
+        queue = sum(_sizeof(music, seen) for music in entries)
+        source = self.current.source if self.current else None
+        buffer = getattr(source, 'buffer', None)
+        return {
+            'tracks' : len(entries),
+            'queue' : queue,
+            'buffers' : len(buffer.ring._buffer) if buffer is not None else 0
+        }
+
+    def snapshot(self):
+        '''
+        Describe what the state plays with ids and numbers only, see `QueueStore`
+
+        :Returns:
+            - snapshot `dict`: voice channel, loop, volume, the current entry with its
+                position in seconds and the queued entries, `None` if there is nothing to resume
+        '''
+        if not self.voice or (self.current is None and not len(self.songs)):
+            return None
+        # the current entry only counts while its audio is open, not after it ended or was stopped
+        current = self.current if self.current is not None and self.current.source is not None else None
+        position = current.source.position if current is not None else 0
+        if self._resume is not None and len(self.songs) and self.songs[0] is self._resume[0]:
+            # a restored track that has not been reopened yet
+            current, position = self._resume
+        return {
+            'voice' : self.voice.channel.id,
+            'loop' : self._loop,
+            'volume' : self._volume,
+            'current' : _entry(current) + [round(position, 1)] if current is not None else None,
+            'queue' : [_entry(music) for music in self.songs if music is not current]
+        }
+
+    async def restore(self, snapshot: dict, guild: discord.Guild):
+        '''
+        Rebuild the queue of a snapshot, rejoin its voice channel and resume the
+        current track where it stopped. The entries reopen their audio when they
+        are played, like any queued track.
+
+        :Args:
+            - snapshot `dict`: returned by `snapshot` before the restart
+            - guild `discord.Guild`: guild the snapshot belongs to
+        :Returns:
+            - restored `bool`: whether anything plays again
+        '''
+        voice = guild.get_channel(snapshot['voice'])
+        current = snapshot['current']
+        entries = ([current[:6]] if current else []) + snapshot['queue']
+        if voice is None or not entries:
+            return False
+
+        # served by the local metadata store, only expired records are requested again
+        songs = {song['id']: song for song in await self.ncm.get_song([entry[0] for entry in entries]) or []}
+        members = {}
+        queue = []
+        for id, songId, requesterId, channelId, br, download in entries:
+            info = songs.get(id)
+            channel = guild.get_channel(channelId)
+            if info is None or channel is None:
+                queue.append(None)
+                continue
+            if requesterId not in members:
+                members[requesterId] = await self._member(guild, requesterId)
+            queue.append(musicSource.Music(None, info, songId, br=br, download=bool(download),
+                                           requester=members[requesterId], channel=channel))
+        if current and queue[0] is not None:
+            self._resume = (queue[0], current[6])
+        queue = [music for music in queue if music is not None]
+        if not queue:
+            return False
+
+        self._loop = snapshot['loop']
+        self._volume = snapshot['volume']
+        # a connection kept by the previous instance of the cog is taken over
+        self.voice = guild.voice_client
+        if self.voice is None or not self.voice.is_connected():
+            if self.voice is not None:
+                await self.voice.disconnect(force=True)
+            self.voice = await voice.connect()
+        for music in queue:
+            try:
+                self.songs.put_nowait(music)
+            except asyncio.QueueFull:
+                print('Queue of {} is full, {} restored tracks dropped'.format(guild, len(queue) - len(self.songs)))
+                break
+        self.start()
+        return True
+
+    @staticmethod
+    async def _member(guild: discord.Guild, id: int):
+        member = guild.get_member(id)
+        if member is None:
+            try:
+                member = await guild.fetch_member(id)
+            except discord.HTTPException:
+                # the requester left the guild, the bot stands in for them
+                member = guild.me
+        return member
+
+    def _updated(self):
+        if self.on_update is not None:
+            self.on_update()
 
     @property
     def loop(self):
@@ -31,6 +202,14 @@ class VoiceState:
     @loop.setter
     def loop(self, value: bool):
         self._loop = value
+        self._updated()
+        if value:
+            # the current track repeats instead of moving on, nothing needs to stay open for the next one
+            self._unqueue()
+            self.prefetcher.cancel()
+            self.prefetcher.discard_stale(keep=False)
+        elif self.current is not None and self.current.source is not None:
+            self.prefetcher.schedule(self.current, self._volume)
 
     @property
     def volume(self):
@@ -39,16 +218,128 @@ class VoiceState:
     @volume.setter
     def volume(self, value: float):
         self._volume = value
+        self._updated()
+        source = self.current.source if self.current else None
+        if source is None:
+            return
+        if source.is_opus():
+            # the volume is part of the ffmpeg filter graph, reopen at the current position
+            self.bot.loop.create_task(self.restart())
+            self._unqueue()
+        else:
+            source.volume = value
+            upcoming = self.mixer.upcoming if self.mixer else None
+            if upcoming is not None:
+                upcoming[1].volume = value
+
+    @staticmethod
+    def requester_of(music):
+        return music.requester.id
+
+    def target_bitrate(self, ctx: commands.Context = None):
+        '''
+        :Returns:
+            - bitrate `int`: upstream bitrate new tracks should be fetched at
+        '''
+        if self.bitrate:
+            return self.bitrate
+        channel = self.voice.channel if self.voice else None
+        if channel is None and ctx is not None and ctx.author.voice:
+            channel = ctx.author.voice.channel
+        return QualityPolicy.target(channel.bitrate if channel else None)
+
+    def buffer_stats(self):
+        '''
+        :Returns:
+            - stats `dict`: read-ahead fill level of the playing source and underruns since the state was created
+        '''
+        source = self.current.source if self.current else None
+        stats = source.buffer_stats() if source is not None else None
+        stats = dict(stats or {'fill' : 0, 'capacity' : 0, 'underruns' : 0})
+        stats['underruns'] += self.underruns
+        return stats
+
+    def _count_underruns(self, source):
+        stats = source.buffer_stats()
+        if stats:
+            self.underruns += stats['underruns']
+
+    def _release(self, source):
+        self._count_underruns(source)
+        source.cleanup()
+
+    def _queue_changed(self):
+        upcoming = self.mixer.upcoming if self.mixer else None
+        if upcoming is not None and (not len(self.songs) or self.songs[0] is not upcoming[0]):
+            self._unqueue()
+        self.prefetcher.discard_stale()
+
+    def _unqueue(self):
+        '''
+        Give the track queued in the mixer back to the prefetcher, or release
+        it while the current track loops
+        '''
+        upcoming = self.mixer.unqueue() if self.mixer else None
+        if upcoming is None:
+            return
+        if self.loop:
+            self._release(upcoming[1])
+        else:
+            self.prefetcher.adopt(*upcoming)
+
+    def _source_ready(self, music):
+        '''
+        Queue the prefetched source of the next track in the mixer for a gapless transition
+        '''
+        mixer = self.mixer
+        if mixer is None or mixer.upcoming is not None or self.loop or self.current is None or \
+                not len(self.songs) or self.songs[0] is not music:
+            return
+        if not (self.voice and (self.voice.is_playing() or self.voice.is_paused())):
+            return
+        source = self.prefetcher.take_ready(music)
+        if source is None:
+            return
+        if source.is_opus() and source.volume != self._volume:
+            # opened before a volume change, `audio_player_task` reopens it
+            self.prefetcher.adopt(music, source)
+            return
+        source.volume = self._volume
+        mixer.queue(music, source)
+
+    def _switched(self, old, music):
+        # called from the voice player thread once the mixer moved on to `music`
+        def handed_over():
+            self._handedOver = music
+            self.next.set()
+        self.bot.loop.call_soon_threadsafe(handed_over)
 
     @property
     def is_playing(self):
         return self.voice and self.current
 
     async def audio_player_task(self):
+        retries = 0
+        resume = 0      # position a retried track is reopened at
         while True:
             self.next.clear()
+            music, self._handedOver = self._handedOver, None
+            if music is not None:
+                # the mixer already plays the next entry, take it off the queue
+                if len(self.songs) and self.songs[0] is music:
+                    self.songs.get_nowait()
+                self.current = music
+                self.current.source = self.mixer.current
+                self._updated()
+                if not self.loop:
+                    self.prefetcher.schedule(self.current, self._volume)
+                await self.current.channel.send(embed=self.current.create_embed())
+                await self.next.wait()
+                retries, resume = self._finished(retries)
+                continue
 
-            if not self.loop:
+            # a retried track is reopened instead of taking the next one
+            if not retries and (not self.loop or self.current is None):
                 # Try to get the next song within 3 minutes.
                 # If no song will be added to the queue in time,
                 # the player will disconnect due to performance
@@ -57,22 +348,126 @@ class VoiceState:
                     async with timeout(180):  # 3 minutes
                         self.current = await self.songs.get()
                 except asyncio.TimeoutError:
+                    self.current = None
+                    self._updated()
                     self.bot.loop.create_task(self.stop())
                     print('leaving the server')
                     return
 
-            self.current.source.volume = self._volume
+            if self._resume is not None:
+                # the first track after a restore continues where it stopped
+                if self._resume[0] is self.current:
+                    resume = self._resume[1]
+                self._resume = None
+
+            # the queue only holds track references, use the prefetched audio or open it now
+            try:
+                source = await self.prefetcher.take(self.current)
+                self.prefetcher.discard_stale()
+                if source is None or (source.is_opus() and source.volume != self._volume):
+                    if source is not None:
+                        source.cleanup()
+                    source = await self.current.open_source(self.ncm, volume=self._volume, start=resume)
+                else:
+                    source.volume = self._volume
+                self.current.source = source
+                self._updated()
+            except musicSource.NetEaseMusicError as e:
+                print(str(e))
+                await self.current.channel.send('Unavailable! Skipping {}'.format(str(self.current)))
+                self.current = None
+                retries = 0
+                resume = 0
+                continue
+
             print('playing music with voice', self.voice)
-            self.voice.play(self.current.source, after=self.play_next_song)
-            await self.current.source.channel.send(embed=self.current.create_embed())
+            self.mixer = TrackMixer(source, self.crossfade, on_switch=self._switched)
+            try:
+                self.voice.play(self.mixer, after=self.play_next_song)
+            except discord.ClientException as e:
+                # e.g. the voice connection was lost, leave so the next `.play` joins again
+                print(f'ERROR: {type(e).__name__} - {e}')
+                self.mixer = None
+                self._release(source)
+                self.current.source = None
+                await self.current.channel.send('Lost the voice connection, stopped playing.')
+                self.current = None
+                self._updated()
+                self.bot.loop.create_task(self.stop())
+                return
+            if not self.loop and not retries:
+                self.prefetcher.schedule(self.current, self._volume)
+            if not retries:
+                await self.current.channel.send(embed=self.current.create_embed())
 
             await self.next.wait()
+            retries, resume = self._finished(retries)
+
+    def _finished(self, retries: int):
+        '''
+        Release the source of the track that just ended
+
+        :Returns:
+            - retries `int`, resume `float`: attempts so far and position to reopen the track at, both 0 to move on
+        '''
+        # a looped track reopens a fresh source
+        # (`restart` may have replaced the source that was started)
+        source = self.current.source
+        self.current.source = None
+        error, self._error = self._error, None
+
+        if self._handedOver is not None:
+            # the mixer moved on without stopping the player, the old source is ours to release
+            self._release(source)
+            return 0, 0
+
+        self._count_underruns(source)
+        # a next track queued in the mixer did not play, e.g. after a skip
+        self._unqueue()
+        self.mixer = None
+
+        # the stream broke off mid-song, resolve the url again and resume where it stopped
+        if (error or source.failed) and retries < self.STREAM_RETRIES:
+            print('Stream of {} failed at {:.1f}s ({}), resuming'.format(
+                self.current, source.position, error or source.httpError or 'ended early'))
+            self.ncm.invalidate_audio_file(self.current.songId, self.current.br)
+            return retries + 1, source.position
+        return 0, 0
 
     def play_next_song(self, error=None):
+        # called from the voice player thread
         if error:
-            raise VoiceError(str(error))
+            print('Player error: {}'.format(error))
+            self._error = error
+        self.bot.loop.call_soon_threadsafe(self.next.set)
+
+    async def restart(self, position: float = None):
+        '''
+        Reopen the current track at `position` seconds, its current position by default,
+        and swap it into the running voice player without ending the track.
+        Used for volume changes of Opus sources and by `.seek`.
+        '''
+        old = self.current.source if self.current else None
+        if old is None:
+            return
+        position = old.position if position is None else position
+        source = await self.current.open_source(self.ncm, volume=self._volume, start=position)
+
+        # the track ended or changed while the new source was opening
+        if self.current is None or self.current.source is not old or \
+                not (self.voice.is_playing() or self.voice.is_paused()):
+            source.cleanup()
+            return
 
-        self.next.set()
+        if self.mixer is None or not self.mixer.replace(old, source):
+            source.cleanup()
+            return
+        self.current.source = source
+        # the player thread may still be reading the old source for this frame
+        self.bot.loop.call_later(1, self._release, old)
+        if not self.loop:
+            # the end of the track moved with the position
+            self.prefetcher.schedule(self.current, self._volume)
 
     def skip(self):
         self.skip_votes.clear()
@@ -82,7 +477,70 @@ class VoiceState:
 
     async def stop(self):
         self.songs.clear()
+        self._unqueue()
+        self.prefetcher.clear()
 
         if self.voice:
             await self.voice.disconnect()
             self.voice = None
+        self._updated()
+
+    def detach(self):
+        '''
+        Release the player task and every opened source like `close`, but keep
+        the voice connection for the state restored by the reloaded cog
+        '''
+        self.on_update = None
+        self.songs.clear()
+        self._unqueue()
+        self.prefetcher.clear()
+        if self.audio_player is not None:
+            self.audio_player.cancel()
+            self.audio_player = None
+        if self.voice:
+            self.voice.stop()
+            self.voice = None
+        if self.current is not None and self.current.source is not None:
+            self.current.source.cleanup()
+            self.current.source = None
+        self.current = None
+        self.mixer = None
+
+    async def close(self):
+        '''
+        Stop playing and release the player task and every opened source
+        '''
+        await self.stop()
+        if self.audio_player is not None:
+            self.audio_player.cancel()
+            self.audio_player = None
+        if self.current is not None and self.current.source is not None:
+            self.current.source.cleanup()
+            self.current.source = None
+        self.current = None
+        self.mixer = None
+
+
+def _entry(music):
+    # a queue entry in a snapshot: [track id, playable song id, requester id, text channel id, bitrate, download]
+    return [music.id, music.songId, music.requester.id, music.channel.id, music.br, int(music.download)]
+
+
+def _sizeof(value, seen=None):
+    '''
+    Size in bytes of a value and of the containers and strings it holds
+    '''
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_sizeof(key, seen) + _sizeof(item, seen) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set)):
+        size += sum(_sizeof(item, seen) for item in value)
+    elif isinstance(value, (musicSource.Music, TrackRecord, Artist, Album)):
+        # slotted records, the requester, channel and open source are not part of the entry
+        size += sum(_sizeof(getattr(value, name, None), seen) for name in value.__slots__
+                    if name not in ('requester', 'channel', 'source', '__weakref__'))
+    return size